@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# Generate a recoll configuration directory and a document tree for the fake recoll package:
+#   DIR/conf/recoll.conf   topdirs = DIR/docs, plus the webui_ parameters given with -p
+#   DIR/docs/d0/d1/...     fanout ** depth folders, each with some text documents
+#
+# Run the WebUI on it with, from the top directory:
+#   RECOLL_CONFDIR=DIR/conf PYTHONPATH=bench/fakerecoll ./webui-standalone.py
+#
+# Usage: bench/fakerecoll/fakecorpus.py [-f fanout] [-d depth] [-n files] [-s KB] DIR
+import os
+import random
+import argparse
+
+WORDS = ('index search result document folder archive message report summary letter invoice '
+         'meeting project budget network server backup picture music recipe travel garden '
+         'library kernel python recoll xapian query stemming language synonym').split()
+
+# Create the tree and the configuration, return the configuration directory
+def make_corpus(topdir, fanout=5, depth=3, files=4, docsize=16, params=None):
+    rng = random.Random(0)
+    docs = os.path.join(topdir, 'docs')
+    text = ''
+    while len(text) < docsize * 1024:
+        text += ' '.join(rng.choice(WORDS) for _ in range(12)) + '\n'
+    dirs = [docs]
+    level = [docs]
+    for _ in range(depth):
+        level = [os.path.join(d, 'd%d' % i) for d in level for i in range(fanout)]
+        dirs.extend(level)
+    for d in dirs:
+        os.makedirs(d, exist_ok=True)
+        for i in range(files):
+            with open(os.path.join(d, 'doc%d.txt' % i), 'w') as f:
+                f.write(text)
+    confdir = os.path.join(topdir, 'conf')
+    os.makedirs(confdir, exist_ok=True)
+    with open(os.path.join(confdir, 'recoll.conf'), 'w') as f:
+        f.write('topdirs = %s\n' % docs)
+        for k, v in (params or {}).items():
+            f.write('%s = %s\n' % (k, v))
+    return confdir
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--fanout', type=int, default=5, help='subfolders per folder [5]')
+    parser.add_argument('-d', '--depth', type=int, default=3, help='folder tree depth [3]')
+    parser.add_argument('-n', '--files', type=int, default=4, help='documents per folder [4]')
+    parser.add_argument('-s', '--docsize', type=int, default=16, help='document size in KB [16]')
+    parser.add_argument('-p', '--param', action='append', default=[],
+                        help='recoll.conf parameter, as name=value')
+    parser.add_argument('dir')
+    args = parser.parse_args()
+    params = dict(p.split('=', 1) for p in args.param)
+    print(make_corpus(args.dir, args.fanout, args.depth, args.files, args.docsize, params))
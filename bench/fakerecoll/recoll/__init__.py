@@ -0,0 +1,14 @@
+# A fake Recoll Python package, for running the WebUI and measuring its performance without a Recoll
+# index. It has the parts of the recoll, rclextract and rclconfig modules which webui.py uses.
+#
+# Every query matches a synthetic corpus, generated from the parameters below, which can be set
+# in the environment before the import (e.g. for webui-standalone.py), or changed in
+# recoll.recoll.PARAMS afterwards:
+#   FAKERECOLL_HITS       number of results of a query [1000]. A query containing hits:N gets N
+#   FAKERECOLL_FIELDSIZE  size in characters of the title, abstract and keywords fields [200]
+#   FAKERECOLL_ABSTRACTUS CPU time of a makedocabstract() call, in microseconds [200]
+#   FAKERECOLL_EXECUTEUS  time of a query execute(), in microseconds, spent waiting [1000]
+#
+# The results point to the files under the topdirs of the recoll configuration, in turn, so that
+# preview and download work. bench/fakerecoll/fakecorpus.py generates a configuration and a
+# document tree.
@@ -0,0 +1,25 @@
+# Fake rclconfig: reads recoll.conf from the configuration directory, like the real one (without
+# the system defaults and the per-directory sections)
+import os
+import conftree
+
+class RclConfig:
+    def __init__(self, argcnf=None):
+        if argcnf:
+            confdir = argcnf
+        elif 'RECOLL_CONFDIR' in os.environ:
+            confdir = os.environ['RECOLL_CONFDIR']
+        else:
+            confdir = '~/.recoll'
+        self.confdir = os.path.abspath(os.path.expanduser(confdir))
+        self.conf = conftree.ConfTree(os.path.join(self.confdir, 'recoll.conf'))
+
+    def getConfDir(self):
+        return self.confdir
+
+    def getDbDir(self):
+        dbdir = os.path.expanduser(self.getConfParam('dbdir') or 'xapiandb')
+        return os.path.join(self.confdir, dbdir)
+
+    def getConfParam(self, nm):
+        return self.conf.get(nm)
@@ -0,0 +1,27 @@
+# Fake rclextract: the documents are plain text files
+import os
+import shutil
+import tempfile
+
+from recoll import recoll
+
+class Extractor:
+    def __init__(self, doc):
+        self.doc = doc
+
+    def _path(self):
+        return self.doc.url[len('file://'):]
+
+    def textextract(self, ipath):
+        doc = recoll.Doc()
+        with open(self._path(), 'r', encoding='utf-8', errors='replace') as f:
+            doc.text = f.read()
+        doc.mimetype = 'text/plain'
+        return doc
+
+    def idoctofile(self, ipath, targetmtype, outfile=''):
+        if not outfile:
+            fd, outfile = tempfile.mkstemp(prefix='fakerecoll-')
+            os.close(fd)
+        shutil.copyfile(self._path(), outfile)
+        return outfile
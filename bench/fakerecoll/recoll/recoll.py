@@ -0,0 +1,167 @@
+# Fake recoll module: see __init__.py
+import os
+import re
+import time
+import random
+import shlex
+
+from recoll import rclconfig
+
+PARAMS = {
+    'hits': int(os.environ.get('FAKERECOLL_HITS', 1000)),
+    'fieldsize': int(os.environ.get('FAKERECOLL_FIELDSIZE', 200)),
+    'abstractus': int(os.environ.get('FAKERECOLL_ABSTRACTUS', 200)),
+    'executeus': int(os.environ.get('FAKERECOLL_EXECUTEUS', 1000)),
+}
+
+WORDS = ('index search result document folder archive message report summary letter invoice '
+         'meeting project budget network server backup picture music recipe travel '
+         'garden library kernel python recoll xapian query stemming language synonym').split()
+
+# Field values are taken in turn from a pool, generated once per size, so that the fake costs
+# little compared to what is measured
+_g_pools = {}
+def _pool(size):
+    if size not in _g_pools:
+        rng = random.Random(size)
+        values = []
+        for _ in range(64):
+            text = ''
+            while len(text) < size:
+                text += rng.choice(WORDS) + ' '
+            values.append(text[:size].strip())
+        _g_pools[size] = values
+    return _g_pools[size]
+
+# The documents of the corpus: the files under the topdirs of each configuration directory
+_g_files = {}
+def _files(confdir):
+    if confdir not in _g_files:
+        rclconf = rclconfig.RclConfig(confdir)
+        files = []
+        for top in shlex.split(rclconf.getConfParam('topdirs') or ''):
+            for dirpath, dirnames, filenames in os.walk(os.path.expanduser(top)):
+                dirnames.sort()
+                files.extend(os.path.join(dirpath, f) for f in sorted(filenames))
+        _g_files[confdir] = files or ['/nonexistent/document.txt']
+    return _g_files[confdir]
+
+class Doc:
+    def __init__(self):
+        object.__setattr__(self, '_fields', {})
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self._fields.get(name)
+
+    def __setattr__(self, name, value):
+        self._fields[name] = value
+
+    def __getitem__(self, name):
+        return self._fields[name]
+
+    def get(self, name):
+        return self._fields.get(name)
+
+    def keys(self):
+        return list(self._fields.keys())
+
+    def getbinurl(self):
+        return self._fields['url'].encode('utf-8', 'surrogateescape')
+
+    def setbinurl(self, url):
+        self._fields['url'] = url.decode('utf-8', 'surrogateescape')
+
+def _makedoc(files, i):
+    pool = _pool(PARAMS['fieldsize'])
+    path = files[i % len(files)]
+    mtime = str(1600000000 + 3600 * i)
+    size = str(1000 + i)
+    doc = Doc()
+    doc._fields.update({
+        'url': 'file://' + path, 'ipath': '', 'filename': os.path.basename(path),
+        'title': pool[i % len(pool)], 'abstract': pool[(i + 1) % len(pool)],
+        'keywords': pool[(i + 2) % len(pool)], 'author': 'Author %d' % (i % 100),
+        'mtype': 'text/plain', 'mimetype': 'text/plain', 'origcharset': 'utf-8',
+        'mtime': mtime, 'dmtime': mtime, 'fmtime': mtime, 'fbytes': size, 'dbytes': size,
+        'size': size, 'sig': size + mtime, 'relevancyrating': '%d%%' % max(1, 100 - i % 100),
+        'collapsecount': '0', 'rcludi': 'fake|%d' % i,
+    })
+    return doc
+
+def _spin(us):
+    end = time.perf_counter() + us / 1e6
+    while time.perf_counter() < end:
+        pass
+
+class Query:
+    def __init__(self, db):
+        self.db = db
+        self.rowcount = -1
+        self.next = -1
+        self.terms = []
+
+    def sortby(self, field, ascending=True):
+        pass
+
+    def execute(self, query_string, stemming=1, stemlang='english', fetchtext=False,
+                collapseduplicates=False):
+        time.sleep(PARAMS['executeus'] / 1e6)
+        m = re.search(r'\bhits:(\d+)', query_string)
+        self.rowcount = int(m.group(1)) if m else PARAMS['hits']
+        self.terms = [w for w in re.findall(r'\w+', query_string) if w in WORDS]
+        self.next = 0
+        return self.rowcount
+
+    def getxquery(self):
+        return 'Query(%s)' % ' OR '.join(self.terms)
+
+    def scroll(self, value, mode='relative'):
+        pos = value if mode == 'absolute' else self.next + value
+        if pos < 0 or pos >= self.rowcount:
+            raise IndexError('scroll out of range')
+        self.next = pos
+
+    def fetchone(self):
+        if self.next < 0 or self.next >= self.rowcount:
+            return None
+        doc = _makedoc(self.db.files, self.next)
+        self.next += 1
+        return doc
+
+    def _highlight(self, text, methods):
+        if not methods:
+            return text
+        for i, term in enumerate(self.terms):
+            text = text.replace(term, methods.startMatch(i) + term + methods.endMatch())
+        return text
+
+    def makedocabstract(self, doc, methods=None):
+        _spin(PARAMS['abstractus'])
+        return self._highlight(doc.abstract, methods)
+
+    def highlight(self, text, ishtml=0, eolbr=1, methods=None):
+        return self._highlight(text, methods)
+
+class Db:
+    def __init__(self, confdir=None, extra_dbs=None):
+        self.files = _files(rclconfig.RclConfig(confdir).getConfDir())
+
+    def setAbstractParams(self, maxchars, contextwords):
+        pass
+
+    def setSynonymsFile(self, path):
+        pass
+
+    def query(self):
+        return Query(self)
+
+    def getDoc(self, udi, idxi=0):
+        return _makedoc(self.files, int(udi.rsplit('|', 1)[-1]))
+
+    def close(self):
+        pass
+
+def connect(confdir=None, extra_dbs=None, writable=False):
+    return Db(confdir, extra_dbs)
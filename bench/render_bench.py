@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# Measure the template rendering cost of a results page, in bottle debug mode (templates reloaded
+# and compiled for every request, what webui-standalone.py --debug does) and in production mode
+# (templates compiled once by webui.compile_templates()).
+#
+# Usage: bench/render_bench.py [-n iterations] [-r results per page]
+import os
+import sys
+import time
+import datetime
+import argparse
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--iterations', type=int, default=200, help='renders per mode [200]')
+parser.add_argument('-r', '--results', type=int, default=25, help='results on the page [25]')
+args = parser.parse_args()
+
+topdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, topdir)
+# Rendering needs no index: the fake recoll package is enough to import webui
+sys.path.insert(0, os.path.join(topdir, 'bench', 'fakerecoll'))
+os.chdir(topdir)
+import webui
+
+def make_page(nres):
+    config = dict(webui.DEFAULTS)
+    config.update({'perpage': nres, 'mounts': {'/home/me/docs': 'file:///home/me/docs'},
+                   'commonprefix': '/home/me/', 'rclc_nojsoncsv': 0, 'rclc_nozip': 0,
+                   'rclc_nosettings': 0})
+    res = []
+    for i in range(nres):
+        res.append({'url': 'file:///home/me/docs/dir%d/document-%d.pdf' % (i % 7, i),
+                    'ipath': '', 'label': 'Document number %d' % i, 'title': 'Document %d' % i,
+                    'abstract': 'abstract ' * 20, 'author': 'Some Author', 'collapsecount': 0,
+                    'sha': '%040x' % i, 'time': 'Mon Jan  1 00:00:00 2024', 'rcludi': 'udi%d' % i,
+                    'snippet': 'some <span class="search-result-highlight">match</span> ' * 30})
+    query = {'query': 'match', 'before': '', 'after': '', 'dir': '<all>',
+             'sort': 'relevancyrating', 'ascending': 0, 'page': 1, 'highlight': 1, 'snippets': 1}
+    return {'res': res, 'time': datetime.timedelta(seconds=0.1), 'query': query,
+            'dirs': ['<all>'] + ['docs/dir%d' % i for i in range(50)], 'qs': 'match',
+            'sorts': webui.SORTS, 'config': config, 'query_string': 'query=match&page=1',
+            'nres': nres * 10, 'approx': False, 'count': nres * 10, 'truncated': False}
+
+def bench(page, n):
+    webui.bottle.template('results', **page)
+    t0 = time.perf_counter()
+    for _ in range(n):
+        webui.bottle.template('results', **page)
+    return (time.perf_counter() - t0) / n
+
+page = make_page(args.results)
+
+webui.bottle.debug(True)
+debug = bench(page, args.iterations)
+webui.bottle.debug(False)
+webui.bottle.TEMPLATES.clear()
+webui.compile_templates()
+production = bench(page, args.iterations)
+
+print("results.tpl with %d results, %d renders" % (args.results, args.iterations))
+print("  debug mode:      %8.3f ms/render" % (debug * 1000))
+print("  production mode: %8.3f ms/render" % (production * 1000))
+print("  speedup:         %8.1fx" % (debug / production))
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# Replay a query log against a running server, to check its capacity (e.g. before an upgrade), or
+# to compare server modes (threads, workers, WSGI).
+#
+# The log is the JSON lines query log (webui_querylog), or a log with the "Query: " lines which
+# webui_logquery used to print. The searches are replayed on the route they were made on
+# (/results, /json or /csv), with the same page, sort and folder. Each results page may be followed
+# by a preview or a download of one of its results and, for the plain logs which don't record the
+# pages, by the next page. The proportions are set with --preview, --download and --flip.
+#
+# The requests are sent from --concurrency threads, each with a persistent connection, and
+# searches are started at --rate per second (as fast as possible if 0). The report gives the
+# throughput, and the latency percentiles for each kind of request, the time to the end of the
+# response.
+#
+# Usage: bench/replay.py [-c concurrency] [-r rate] [-n searches] LOGFILE URL
+#    eg: bench/replay.py -c 8 -r 20 /var/log/recoll-webui/queries.log http://localhost:8080
+import sys
+import time
+import json
+import queue
+import random
+import argparse
+import threading
+import http.client
+import urllib.parse
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-c', '--concurrency', type=int, default=4, help='parallel requests [4]')
+parser.add_argument('-r', '--rate', type=float, default=0,
+                    help='searches started per second, 0 for as fast as possible [0]')
+parser.add_argument('-n', '--searches', type=int, default=0,
+                    help='stop after this number of searches, going through the log again if '
+                    'needed [once through the log]')
+parser.add_argument('--flip', type=float, default=None,
+                    help='probability of going to the next page after a results page '
+                    '[0 for a JSON log, which has the recorded pages, else 0.2]')
+parser.add_argument('--preview', type=float, default=0.3,
+                    help='probability of previewing a result after a results page [0.3]')
+parser.add_argument('--download', type=float, default=0.1,
+                    help='probability of downloading a result after a results page [0.1]')
+parser.add_argument('--perpage', type=int, default=25,
+                    help='results per page on the server, to choose the results [25]')
+parser.add_argument('-H', '--header', action='append', default=[],
+                    help='extra request header, as "Name: value" (e.g. for authentication)')
+parser.add_argument('--seed', type=int, default=0, help='random seed [0]')
+parser.add_argument('logfile')
+parser.add_argument('url')
+args = parser.parse_args()
+
+ROUTES = ('/results', '/json', '/csv')
+
+# The searches from the log, as (route, query parameters) with the recorded page
+def read_log(logfile):
+    searches = []
+    plain = True
+    with open(logfile, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            if line.startswith('{'):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                plain = False
+                route = record.get('route', '/results')
+                if not record.get('query') or route not in ROUTES:
+                    continue
+                params = {'query': record['query'], 'page': record.get('page') or 1}
+                if record.get('sort'):
+                    params['sort'] = record['sort']
+                    params['ascending'] = record.get('ascending') or 0
+                if route != '/results':
+                    params['page'] = 0
+                searches.append((route, params))
+            else:
+                pos = line.find('Query: ')
+                if pos >= 0 and line[pos+7:].strip():
+                    searches.append(('/results', {'query': line[pos+7:].strip(), 'page': 1}))
+    return searches, plain
+
+# The requests of a search, as (kind, path, query parameters)
+def requests_for(route, params, rng, flip):
+    if route != '/results':
+        return [('export', route, params)]
+    reqs = [('flip' if params['page'] > 1 else 'results', route, params)]
+    if rng.random() < flip:
+        reqs.append(('flip', route, dict(params, page=params['page'] + 1)))
+    first = (params['page'] - 1) * args.perpage
+    for kind, p in (('preview', args.preview), ('download', args.download)):
+        if rng.random() < p:
+            reqs.append((kind, '/%s/%d' % (kind, first + rng.randrange(args.perpage)),
+                         {'query': params['query']}))
+    return reqs
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.bytes = 0
+
+    def add(self, kind, secs, nbytes, error):
+        with self.lock:
+            if error:
+                self.errors.setdefault(kind, []).append(error)
+            else:
+                self.latencies.setdefault(kind, []).append(secs)
+                self.bytes += nbytes
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+url = urllib.parse.urlsplit(args.url)
+prefix = url.path.rstrip('/')
+headers = dict(h.split(':', 1) for h in args.header)
+headers = {k.strip(): v.strip() for k, v in headers.items()}
+
+def connect():
+    if url.scheme == 'https':
+        return http.client.HTTPSConnection(url.netloc, timeout=300)
+    return http.client.HTTPConnection(url.netloc, timeout=300)
+
+def worker(jobs, stats):
+    conn = connect()
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        for kind, path, params in job:
+            target = prefix + path + '?' + urllib.parse.urlencode(params)
+            t0 = time.perf_counter()
+            try:
+                conn.request('GET', target, headers=headers)
+                resp = conn.getresponse()
+                nbytes = len(resp.read())
+                error = None if resp.status < 400 else 'HTTP %d' % resp.status
+            except (OSError, http.client.HTTPException) as ex:
+                conn.close()
+                conn = connect()
+                nbytes, error = 0, '%s' % (ex or type(ex).__name__)
+            stats.add(kind, time.perf_counter() - t0, nbytes, error)
+
+searches, plain = read_log(args.logfile)
+if not searches:
+    sys.exit('no searches found in %s' % args.logfile)
+flip = args.flip if args.flip is not None else (0.2 if plain else 0)
+nsearches = args.searches or len(searches)
+rng = random.Random(args.seed)
+
+stats = Stats()
+jobs = queue.Queue(maxsize=args.concurrency * 2)
+threads = [threading.Thread(target=worker, args=(jobs, stats), daemon=True)
+           for _ in range(args.concurrency)]
+for t in threads:
+    t.start()
+t0 = time.perf_counter()
+for i in range(nsearches):
+    if args.rate > 0:
+        delay = t0 + i / args.rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    route, params = searches[i % len(searches)]
+    jobs.put(requests_for(route, params, rng, flip))
+for t in threads:
+    jobs.put(None)
+for t in threads:
+    t.join()
+wall = time.perf_counter() - t0
+
+total = sum(len(v) for v in stats.latencies.values())
+nerrors = sum(len(v) for v in stats.errors.values())
+print("%d searches, %d requests in %.1f s, concurrency %d: %.1f requests/s, %.1f MB/s, %d errors" %
+      (nsearches, total + nerrors, wall, args.concurrency, total / wall,
+       stats.bytes / wall / 1e6, nerrors))
+print("  %-10s %8s %8s %9s %9s %9s %9s" %
+      ('', 'requests', 'errors', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+alllat = []
+for kind in ('results', 'flip', 'preview', 'download', 'export'):
+    lat = sorted(stats.latencies.get(kind, []))
+    errors = stats.errors.get(kind, [])
+    alllat += lat
+    if lat:
+        print("  %-10s %8d %8d %9.1f %9.1f %9.1f %9.1f" %
+              (kind, len(lat), len(errors), percentile(lat, 50) * 1000,
+               percentile(lat, 90) * 1000, percentile(lat, 99) * 1000, lat[-1] * 1000))
+    elif errors:
+        print("  %-10s %8d %8d" % (kind, 0, len(errors)))
+if alllat:
+    alllat.sort()
+    print("  %-10s %8d %8d %9.1f %9.1f %9.1f %9.1f" %
+          ('all', len(alllat), nerrors, percentile(alllat, 50) * 1000,
+           percentile(alllat, 90) * 1000, percentile(alllat, 99) * 1000, alllat[-1] * 1000))
+for kind, errors in stats.errors.items():
+    print("%s errors, first: %s" % (kind, errors[0]))
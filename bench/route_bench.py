@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# Measure the latency and throughput of the main routes and of the costly helpers, without a
+# Recoll index: the fake recoll package in bench/fakerecoll answers every query with a synthetic
+# corpus (see bench/fakerecoll/recoll/__init__.py), over a document tree generated in a temporary
+# directory. The requests go through bottle's WSGI application, as from a server, with no network.
+#
+# Measured:
+# - /results pages, for each of the --perpage values,
+# - /json and /csv exports of all the results (--export-hits of them),
+# - /preview of a document of --docsize KB,
+# - get_dirs() walking the generated tree (uncached), and get_config().
+#
+# Usage: bench/route_bench.py [-n requests] [-c concurrency] [--hits N] [--perpage 10,25,100]...
+import os
+import sys
+import time
+import tempfile
+import argparse
+import statistics
+import concurrent.futures
+from wsgiref.util import setup_testing_defaults
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--requests', type=int, default=200, help='requests per route [200]')
+parser.add_argument('-c', '--concurrency', type=int, default=1,
+                    help='requests in parallel, from as many threads [1]')
+parser.add_argument('--hits', type=int, default=1000, help='results of a query [1000]')
+parser.add_argument('--export-hits', type=int, default=200,
+                    help='results of the queries exported by /json and /csv [200]')
+parser.add_argument('--perpage', default='10,25,100', help='/results page sizes [10,25,100]')
+parser.add_argument('--fieldsize', type=int, default=200,
+                    help='size of the title, abstract and keywords fields [200]')
+parser.add_argument('--abstract-us', type=int, default=200,
+                    help='CPU time of a makedocabstract() call, in microseconds [200]')
+parser.add_argument('--execute-us', type=int, default=1000,
+                    help='time of a query execute(), in microseconds [1000]')
+parser.add_argument('--docsize', type=int, default=16, help='document size in KB [16]')
+parser.add_argument('--fanout', type=int, default=5, help='folder tree fanout [5]')
+parser.add_argument('--depth', type=int, default=3, help='folder tree depth [3]')
+args = parser.parse_args()
+
+topdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+benchdir = os.path.join(topdir, 'bench')
+sys.path.insert(0, topdir)
+sys.path.insert(0, os.path.join(benchdir, 'fakerecoll'))
+os.chdir(topdir)
+os.environ['FAKERECOLL_HITS'] = str(args.hits)
+os.environ['FAKERECOLL_FIELDSIZE'] = str(args.fieldsize)
+os.environ['FAKERECOLL_ABSTRACTUS'] = str(args.abstract_us)
+os.environ['FAKERECOLL_EXECUTEUS'] = str(args.execute_us)
+import fakecorpus
+import webui
+
+def call(path, query_string='', cookies=''):
+    environ = {}
+    setup_testing_defaults(environ)
+    environ['PATH_INFO'] = path
+    environ['QUERY_STRING'] = query_string
+    if cookies:
+        environ['HTTP_COOKIE'] = cookies
+    status = []
+    out = webui.bottle.default_app()(environ, lambda s, h, e=None: status.append(s))
+    size = 0
+    try:
+        for chunk in out:
+            size += len(chunk)
+    finally:
+        if hasattr(out, 'close'):
+            out.close()
+    if not status[0].startswith('200'):
+        raise Exception('%s?%s: %s' % (path, query_string, status[0]))
+    return size
+
+# Run fn(i) n times from the worker threads. Returns the latencies, the wall clock time and the
+# mean response size (None if fn doesn't return one)
+def run(fn, n, concurrency):
+    def timed(i):
+        t0 = time.perf_counter()
+        size = fn(i)
+        return time.perf_counter() - t0, size
+    fn(0)
+    t0 = time.perf_counter()
+    if concurrency <= 1:
+        res = [timed(i) for i in range(n)]
+    else:
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+            res = list(pool.map(timed, range(n)))
+    wall = time.perf_counter() - t0
+    if res[0][1] is None:
+        return [r[0] for r in res], wall, None
+    return [r[0] for r in res], wall, sum(r[1] for r in res) / n
+
+def report(name, lat, wall, size):
+    lat = sorted(lat)
+    p95 = lat[min(len(lat) - 1, int(len(lat) * 0.95))]
+    print("  %-26s %9.2f %9.2f %9.2f %9.1f %9s" %
+          (name, statistics.median(lat) * 1000, p95 * 1000, statistics.mean(lat) * 1000,
+           len(lat) / wall, '' if size is None else '%.1f' % (size / 1024)))
+
+with tempfile.TemporaryDirectory(prefix='route-bench-') as tmpdir:
+    confdir = fakecorpus.make_corpus(tmpdir, args.fanout, args.depth, docsize=args.docsize,
+                                     params={'webui_extractcachedir': os.path.join(tmpdir, 'x')})
+    os.environ['RECOLL_CONFDIR'] = confdir
+    webui.compile_templates()
+
+    print("%d requests per route, concurrency %d, %d hits, abstracts %d us" %
+          (args.requests, args.concurrency, args.hits, args.abstract_us))
+    print("  %-26s %9s %9s %9s %9s %9s" % ('', 'p50 ms', 'p95 ms', 'mean ms', 'req/s', 'KB'))
+    # Vary the query so that nothing could be served from a cache
+    for perpage in [int(p) for p in args.perpage.split(',')]:
+        report('/results perpage=%d' % perpage, *run(
+            lambda i: call('/results', 'query=index+%d&page=%d' % (i, 1 + i % 10),
+                           'perpage=%d' % perpage), args.requests, args.concurrency))
+    for route in ('/json', '/csv'):
+        report(route, *run(
+            lambda i: call(route, 'query=index+%d+hits:%d' % (i, args.export_hits)),
+            args.requests, args.concurrency))
+    report('/preview', *run(
+        lambda i: call('/preview/%d' % (i % 100), 'query=index+%d' % i),
+        args.requests, args.concurrency))
+
+    # The helpers, called in a request context
+    environ = {}
+    setup_testing_defaults(environ)
+    webui.bottle.request.bind(environ)
+    config = webui.get_config()
+    tops = list(config['dirs'].keys())
+    ndirs = len(webui.get_dirs(tops, args.depth))
+    report('get_dirs() %d folders' % ndirs, *run(
+        lambda i: webui.get_dirs(tops, args.depth) and None, args.requests, 1))
+    report('get_config()', *run(lambda i: webui.get_config() and None, args.requests, 1))
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# Measure the startup cost of a server process, each run in a fresh interpreter, as for a new
+# mod_wsgi daemon process or webui-standalone.py worker:
+# - the import time of webui.py, and which of its imports cost the most (python -X importtime),
+# - the time from the import of webui.py to the first response (the search form page, with no
+#   warm-up, so this includes the first template compilation and folder tree walk).
+#
+# Most of the import time is bottle.py itself, which we can't avoid. Targets, for what depends on
+# us: webui.py should add less than 5 ms to the import of bottle.py (the modules only needed by
+# some requests are imported on first use), and the first response should come less than 25 ms
+# after the end of the import.
+#
+# The recoll configuration is the usual one (RECOLL_CONFDIR or ~/.recoll).
+#
+# Usage: bench/startup_bench.py [-n runs] [-t number of imports to show]
+import os
+import sys
+import statistics
+import subprocess
+import argparse
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--runs', type=int, default=10, help='fresh processes per measure [10]')
+parser.add_argument('-t', '--top', type=int, default=10, help='costliest imports to show [10]')
+args = parser.parse_args()
+
+topdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+env = dict(os.environ)
+# Measure what a deployed server sees: with the byte code cache
+env.pop('PYTHONDONTWRITEBYTECODE', None)
+
+FIRST_RESPONSE = '''
+import time
+t0 = time.perf_counter()
+import webui
+t1 = time.perf_counter()
+status = webui.internal_request('/')
+t2 = time.perf_counter()
+print(t1 - t0, t2 - t0, status)
+'''
+
+def run(argv):
+    return subprocess.run([sys.executable] + argv, cwd=topdir, env=env, check=True,
+                          capture_output=True, text=True)
+
+# Returns the webui total import time and its direct imports as {name: cumulative time}, in
+# seconds. The children of a module are listed before it, with more indentation.
+def importtime():
+    out = run(['-X', 'importtime', '-c', 'import webui']).stderr
+    children = {}
+    for line in out.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        name = name[1:]
+        depth = len(name) - len(name.lstrip())
+        name = name.strip()
+        if depth == 0:
+            if name == 'webui':
+                return int(cumulative) / 1e6, children
+            children = {}
+        elif depth == 2:
+            children[name] = int(cumulative) / 1e6
+    raise Exception('webui not found in the -X importtime output')
+
+def ms(secs):
+    return '%8.1f ms' % (secs * 1000)
+
+# Populate the byte code cache
+run(['-c', 'import webui'])
+
+totals = []
+imports = {}
+for _ in range(args.runs):
+    total, children = importtime()
+    totals.append(total)
+    for name, t in children.items():
+        imports.setdefault(name, []).append(t)
+
+firsts = []
+imported = []
+for _ in range(args.runs):
+    t1, t2, status = run(['-c', FIRST_RESPONSE]).stdout.split(None, 2)
+    if not status.startswith('200'):
+        sys.exit('first request failed: %s' % status.strip())
+    imported.append(float(t1))
+    firsts.append(float(t2))
+
+print("Fresh process startup, median of %d runs" % args.runs)
+bottle = statistics.median(imports.get('bottle', [0]))
+print("  import webui (-X importtime):  %s" % ms(statistics.median(totals)))
+print("    excluding bottle:            %s   (target: 5 ms)" %
+      ms(statistics.median(totals) - bottle))
+print("  import webui (wall clock):     %s" % ms(statistics.median(imported)))
+print("  first response:                %s" % ms(statistics.median(firsts)))
+print("    after the import:            %s   (target: 25 ms)" %
+      ms(statistics.median(f - i for f, i in zip(firsts, imported))))
+print("Costliest imports of webui.py (cumulative):")
+top = sorted(imports.items(), key=lambda kv: -statistics.median(kv[1]))[:args.top]
+for name, times in top:
+    print("  %-30s %s" % (name, ms(statistics.median(times))))
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# Document extraction worker for the Recoll WebUI.
+#
+# This is started by webui.py (see ExtractPool) when webui_extractworkers is set, so that
+# pathological documents run their filters in a separate process, where they can be killed on
+# timeout and limited in memory, instead of holding a server thread.
+#
+# Protocol: on stdin, a sequence of pickled jobs, each preceded by its length as a 4 bytes
+# big-endian integer. Each job is answered on the original stdout in the same format with either
+# ('ok', result) or ('error', message).
+import os
+import sys
+import struct
+import pickle
+
+def _read(fd, n):
+    data = b''
+    while len(data) < n:
+        chunk = os.read(fd, n - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+def _write(fd, obj):
+    data = pickle.dumps(obj)
+    data = struct.pack('!I', len(data)) + data
+    while data:
+        n = os.write(fd, data)
+        data = data[n:]
+
+# Rebuild a Doc from the fields transmitted by the server: the Doc objects can't be pickled
+def _makedoc(recoll, job):
+    doc = recoll.Doc()
+    for k, v in job['fields'].items():
+        try:
+            setattr(doc, k, v)
+        except Exception:
+            pass
+    if job.get('binurl'):
+        try:
+            doc.setbinurl(job['binurl'])
+        except Exception:
+            pass
+    return doc
+
+# The extractor takes its configuration from the library state which recoll.connect() sets up,
+# as in the server: keep the index open, and open it again if the configuration directory changes
+_g_db = (None, None)
+def _connect(recoll, confdir):
+    global _g_db
+    if _g_db[1] is None or _g_db[0] != confdir:
+        if confdir:
+            os.environ['RECOLL_CONFDIR'] = confdir
+        _g_db = (confdir, recoll.connect(confdir=confdir) if confdir else recoll.connect())
+    return _g_db[1]
+
+def _run(recoll, rclextract, job):
+    _connect(recoll, job['confdir'])
+    doc = _makedoc(recoll, job)
+    xt = rclextract.Extractor(doc)
+    if job['op'] == 'text':
+        tdoc = xt.textextract(doc.ipath)
+        return tdoc.text, tdoc.mimetype
+    elif job['op'] == 'file':
+        return xt.idoctofile(doc.ipath, doc.mimetype)
+    raise ValueError('unknown operation %s' % job['op'])
+
+def main():
+    memlimit = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    if memlimit:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (memlimit, memlimit))
+    # Keep the protocol channel for ourselves: anything else writing to stdout (filters, library
+    # messages) goes to stderr.
+    infd = sys.stdin.fileno()
+    outfd = os.dup(1)
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+
+    from recoll import recoll, rclextract
+
+    while True:
+        hdr = _read(infd, 4)
+        if hdr is None:
+            return
+        data = _read(infd, struct.unpack('!I', hdr)[0])
+        if data is None:
+            return
+        try:
+            res = ('ok', _run(recoll, rclextract, pickle.loads(data)))
+        except MemoryError:
+            res = ('error', 'extraction exceeded the memory limit')
+        except Exception as ex:
+            res = ('error', '%s' % ex)
+        _write(outfd, res)
+
+if __name__ == '__main__':
+    main()
@@ -20,3 +20,27 @@ function addOpenSearch()
     alert("Your browser does not support OpenSearch search plugins.");
   }
 }
+
+/* Add the checked results (or the whole page if none is checked) to the zip download link */
+function downloadZip(link)
+{
+  var boxes = $("input.zip-select:checked");
+  if (boxes.length == 0) {
+      boxes = $("input.zip-select");
+  }
+  var sels = [];
+  var udis = "";
+  boxes.each(function() {
+      if (this.name == "udi") {
+          udis += "&udi=" + encodeURIComponent(this.value);
+      } else {
+          sels.push(this.value);
+      }
+  });
+  var href = link.href;
+  if (sels.length) {
+      href += "&sel=" + sels.join(",");
+  }
+  window.location = href + udis;
+  return false;
+}
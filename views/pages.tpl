@@ -3,8 +3,12 @@
 %import math
 
 %q = dict(query)
-%def page_href(page):
+%q.pop('cursor', None)
+%def page_href(page, cursor=None):
 	%q['page'] = page
+	%if cursor:
+		%return './results?%s' % urlencode(dict(q, cursor=cursor))
+	%end
 	%return './results?%s' % urlencode(q)
 %end
 %if nres > 0:
@@ -12,7 +16,7 @@
 	%if npages > 1:
 		<div id="pages">
 		<a title="First" class="page" href="{{page_href(1)}}">&#171;</a>
-		<a title="Previous" class="page" href="{{page_href(max(1,query['page']-1))}}">&#8249;</a> &nbsp;
+		<a title="Previous" class="page" href="{{page_href(max(1,query['page']-1), cursors.get('prev'))}}">&#8249;</a> &nbsp;
 		%offset = ((query['page'])//10)*10
 		%for p in range(max(1,offset), min(offset+10,npages+1)):
 			%if p == query['page']:
@@ -22,8 +26,11 @@
 			%end
 			<a href="{{page_href(p)}}" class="{{cls}}">{{p}}</a>
 		%end
-		&nbsp; <a title="Next" class="page" href="{{page_href(min(npages, query['page']+1))}}">&#8250;</a>
+		&nbsp; <a title="Next" class="page" href="{{page_href(min(npages, query['page']+1), cursors.get('next'))}}">&#8250;</a>
+		%# With an estimated count, the last page is not known
+		%if not approx:
 		<a title="Last" class="page" href="{{page_href(npages)}}">&#187;</a>
+		%end
 		</div>
 	%end
 %end
@@ -6,7 +6,15 @@
             %query_string += "&rcludi=" + d["rcludi"]
         %end
     %end
-    <div class="search-result-number"><a href="#r{{d['sha']}}">#{{number}}</a></div>
+    <div class="search-result-number">
+    %if not config['rclc_nozip']:
+        %if config["permlinks"]:
+        <input type="checkbox" class="zip-select" name="udi" value="{{d['rcludi']}}">
+        %else:
+        <input type="checkbox" class="zip-select" name="sel" value="{{number-1}}">
+        %end
+    %end
+    <a href="#r{{d['sha']}}">#{{number}}</a></div>
     %url = d['url'].replace('file://', '')
     %for dr, prefix in config['mounts'].items():
         %url = url.replace(dr, prefix)
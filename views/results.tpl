@@ -1,25 +1,37 @@
-%include('header', title=": " + query['query']+" ("+str(nres)+")")
+%shown = 'about {:,}'.format(count) if approx else str(count)
+%include('header', title=": " + query['query']+" ("+shown+")")
 %include('search', query=query, dirs=dirs, sorts=sorts, config=config)
 <div id="status">
     <div id="found">
-        Found <b>{{nres}}</b> matching: <b><i>{{qs}}</i></b>
+        Found <b>{{shown}}</b> matching: <b><i>{{qs}}</i></b>
         <small class="gray">({{time.seconds}}.{{time.microseconds/10000}}s)</small>
+        %if truncated:
+            <small class="gray">(time limit reached, the results are incomplete)</small>
+        %end
     </div>
-    %if len(res) > 0 and not config['rclc_nojsoncsv']:
+    %if len(res) > 0 and (not config['rclc_nojsoncsv'] or not config['rclc_nozip']):
         <div id="downloads">
+            %if not config['rclc_nojsoncsv']:
             <a href="./json?{{query_string}}&page=0">JSON</a>
             <a href="./csv?{{query_string}}&page=0">CSV</a>
+            %end
+            %if not config['rclc_nozip']:
+            <a href="./zip?{{query_string}}" title="Download the selected results (default: this page) as a zip archive" onClick="return downloadZip(this)">ZIP</a>
+            %end
         </div>
     %end
     <br style="clear: both">
 </div>
-%include('pages', query=query, config=config, nres=nres)
+%include('pages', query=query, config=config, nres=nres, cursors=get('cursors') or {}, approx=approx)
 <div id="results">
 %for i in range(0, len(res)):
     %include('result', d=res[i], i=i, query=query, config=config, query_string=query_string)
 %end
 </div>
-%include('pages', query=query, config=config, nres=nres)
+%include('pages', query=query, config=config, nres=nres, cursors=get('cursors') or {}, approx=approx)
+%if get('timings'):
+<div id="timings" class="gray"><small>{{timings}}</small></div>
+%end
 %include('footer')
 <!-- vim: fdm=marker:tw=80:ts=4:sw=4:sts=4:et:ai
 -->
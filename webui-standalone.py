@@ -1,6 +1,12 @@
 #!/usr/bin/env python3
 import os
+import time
+import signal
+import socket
 import argparse
+import threading
+import traceback
+from select import select as fdselect
 import webui
 
 # handle command-line arguments
@@ -8,6 +14,35 @@ parser = argparse.ArgumentParser()
 parser.add_argument('-a', '--addr', default='127.0.0.1',help='address to bind to [127.0.0.1]')
 parser.add_argument('-p', '--port', default='8080', type=int, help='port to listen on [8080]')
 parser.add_argument('-c', '--config', action='append', help='configuration directory (primary) or extra indices')
+# Debug mode reloads and recompiles the templates for every request. Default to production mode
+# when started by systemd, debug otherwise.
+undersystemd = 'INVOCATION_ID' in os.environ or 'NOTIFY_SOCKET' in os.environ
+mode = parser.add_mutually_exclusive_group()
+mode.add_argument('--debug', dest='debug', action='store_true', default=not undersystemd,
+                  help='debug mode: reload templates for each request '
+                  '[default unless run by systemd]')
+mode.add_argument('--production', dest='debug', action='store_false',
+                  help='production mode: compile templates once at startup')
+# Server tuning. These can also be set in recoll.conf as webui_threads, webui_connection_limit,
+# webui_backlog, webui_channel_timeout and webui_unix_socket. The command line has priority.
+tuning = parser.add_argument_group('server tuning')
+tuning.add_argument('--threads', type=int, help='number of request threads [4]')
+tuning.add_argument('--connection-limit', type=int,
+                    help='maximum number of simultaneous connections [100]')
+tuning.add_argument('--backlog', type=int, help='listen backlog [1024]')
+tuning.add_argument('--channel-timeout', type=int,
+                    help='seconds before an inactive connection is closed [120]')
+tuning.add_argument('--unix-socket', help='listen on this Unix socket instead of addr:port')
+tuning.add_argument('--unix-socket-perms', help='octal permissions for the Unix socket [600]')
+tuning.add_argument('--workers', type=int,
+                    help='number of server processes sharing the listening socket [1]')
+tuning.add_argument('--reuseport', action='store_true',
+                    help='with --workers, each process binds its own socket with SO_REUSEPORT')
+warm = parser.add_argument_group('warm-up')
+warm.add_argument('--warmup-log',
+                  help='query log to take the warm-up queries from [webui_warmuplog]')
+warm.add_argument('--warmup-queries', type=int,
+                  help='number of most frequent queries from the log to run before serving [20]')
 args = parser.parse_args()
 
 if args.config:
@@ -22,7 +57,291 @@ if os.path.dirname(__file__) != "":
     os.chdir(os.path.dirname(__file__))
 
 # set up webui and run in own http server
-webui.bottle.debug(True)
-webui.bottle.run(server='waitress', host=args.addr, port=args.port)
+webui.bottle.debug(args.debug)
+if not args.debug:
+    webui.compile_templates()
+options = {}
+for name, conv in (('threads', int), ('connection_limit', int), ('backlog', int),
+                   ('channel_timeout', int), ('unix_socket', str), ('unix_socket_perms', str),
+                   ('workers', int)):
+    value = getattr(args, name)
+    if value is None:
+        value = webui.get_server_param(name)
+    if value is not None:
+        options[name] = conv(value)
+workers = options.pop('workers', 1)
+# A Unix socket path can only be bound by one socket: all the workers must share it
+reuseport = args.reuseport
+if reuseport and 'unix_socket' in options:
+    webui.msg("--reuseport does not apply to a Unix socket, ignored")
+    reuseport = False
+
+from waitress import serve
+
+#{{{ systemd
+# Send a state notification to systemd (Type=notify services)
+def sd_notify(state):
+    addr = os.environ.get('NOTIFY_SOCKET')
+    if not addr:
+        return
+    if addr[0] == '@':
+        addr = '\0' + addr[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(addr)
+            sock.sendall(state.encode())
+    except OSError as ex:
+        webui.msg("sd_notify failed: %s" % ex)
+
+# Listening sockets passed by systemd socket activation, or None
+def activated_sockets():
+    try:
+        if int(os.environ.get('LISTEN_PID', '0')) != os.getpid():
+            return None
+        nfds = int(os.environ.get('LISTEN_FDS', '0'))
+    except ValueError:
+        return None
+    for name in ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES'):
+        os.environ.pop(name, None)
+    if nfds <= 0:
+        return None
+    return [socket.socket(fileno=fd) for fd in range(3, 3 + nfds)]
+
+# Watchdog ping interval in seconds (half of WatchdogSec), or None
+def watchdog_interval():
+    try:
+        usec = int(os.environ.get('WATCHDOG_USEC', '0'))
+        pid = int(os.environ.get('WATCHDOG_PID', str(os.getpid())))
+    except ValueError:
+        return None
+    if usec <= 0 or pid != os.getpid():
+        return None
+    return usec / 2e6
+
+# Run webui.health_check() every interval seconds and call report() when it succeeds. The checks
+# start at fixed times and time out after half the interval, so that the reports of consecutive
+# successful checks are never more than 1.5 interval apart.
+def start_health_thread(interval, report):
+    def run():
+        due = time.monotonic()
+        while True:
+            if webui.health_check(timeout=interval / 2):
+                report()
+            due += interval
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                due = time.monotonic()
+    threading.Thread(target=run, daemon=True).start()
+#}}}
+#{{{ reload
+# SIGHUP reloads the configuration: see webui.reload(). The listening options (address, threads,
+# workers...) are only read at startup.
+def reload_now(done):
+    try:
+        webui.reload(args.warmup_log, args.warmup_queries)
+    except Exception:
+        traceback.print_exc()
+    done()
+
+# The reload runs in its own thread, the requests are served meanwhile
+def on_sighup(done, start=None):
+    def handler(signum, frame):
+        if start:
+            start()
+        threading.Thread(target=reload_now, args=(done,), daemon=True).start()
+    signal.signal(signal.SIGHUP, handler)
+
+def sd_reloading():
+    sd_notify('RELOADING=1\nMONOTONIC_USEC=%d' % (time.clock_gettime(time.CLOCK_MONOTONIC) * 1e6))
+#}}}
+#{{{ pre-fork
+# Create the listening socket ourselves, for sharing it between worker processes
+def make_socket(reuseport=False):
+    backlog = options.get('backlog', 1024)
+    if 'unix_socket' in options:
+        path = options['unix_socket']
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        os.chmod(path, int(options.get('unix_socket_perms', '600'), 8))
+    else:
+        family, type, proto, _, addr = socket.getaddrinfo(args.addr, args.port,
+                                                          type=socket.SOCK_STREAM,
+                                                          flags=socket.AI_PASSIVE)[0]
+        sock = socket.socket(family, type, proto)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuseport:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(addr)
+    sock.listen(backlog)
+    return sock
+
+# Workers report to the main process through a pipe: "<pid> ready" after the warm-up,
+# "<pid> reloaded" after a reload, and "<pid> ok" after each successful health check if the
+# watchdog is enabled.
+def run_worker(sockets, wfd, interval):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    status = 0
+    def report(state):
+        os.write(wfd, ('%d %s\n' % (os.getpid(), state)).encode())
+    on_sighup(lambda: report('reloaded'))
+    try:
+        if sockets is None:
+            sockets = [make_socket(reuseport=True)]
+        # Each process has its own Db pool and caches
+        webui.warmup(args.warmup_log, args.warmup_queries)
+        report('ready')
+        if interval:
+            start_health_thread(interval, lambda: report('ok'))
+        serve(webui.bottle.default_app(), sockets=sockets, **serve_options)
+    except KeyboardInterrupt:
+        pass
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+    finally:
+        os._exit(status)
+
+def serve_workers(nworkers, sockets):
+    # With SO_REUSEPORT, the kernel distributes the connections between the sockets bound by the
+    # workers. Else the workers inherit the socket created here or passed by systemd.
+    if sockets is None and not reuseport:
+        sockets = [make_socket()]
+    interval = watchdog_interval()
+    rfd, wfd = os.pipe()
+    children = {}
+    lastok = {}
+    stopping = False
+    ready = False
+    # Workers still to reload, and the one reloading with the time it was asked to
+    reloadq = None
+    reloading = None
+
+    def start():
+        pid = os.fork()
+        if pid == 0:
+            os.close(rfd)
+            run_worker(sockets, wfd, interval)
+        children[pid] = time.monotonic()
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        sd_notify('STOPPING=1')
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    # Reload the workers one at a time, so that most of them are serving at any time. Our own
+    # state is reset so that the workers started from now on read the configuration again.
+    def hup(signum, frame):
+        nonlocal reloadq, reloading
+        if stopping:
+            return
+        sd_reloading()
+        webui.reload(warm=False)
+        reloadq = list(children)
+        reloading = None
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, hup)
+    for i in range(nworkers):
+        start()
+    nready = 0
+    buf = b''
+    while children:
+        # Reap the exited workers, restarting them unless we are stopping
+        while children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                pid = 0
+            if pid == 0:
+                break
+            started = children.pop(pid, None)
+            lastok.pop(pid, None)
+            if started is None or stopping:
+                continue
+            webui.msg("Worker %d exited with status %d, restarting" %
+                      (pid, os.waitstatus_to_exitcode(status)))
+            if time.monotonic() - started < 1:
+                # Don't spin if the workers can't start at all
+                time.sleep(1)
+            start()
+        if not children:
+            break
+        # Read the workers reports
+        if fdselect([rfd], [], [], 0.5)[0]:
+            buf += os.read(rfd, 4096)
+            lines = buf.split(b'\n')
+            buf = lines.pop()
+            for line in lines:
+                pid, state = line.decode().split()
+                pid = int(pid)
+                lastok[pid] = time.monotonic()
+                if state == 'ready':
+                    nready += 1
+                elif state == 'reloaded' and reloading and reloading[0] == pid:
+                    reloading = None
+        if not ready and nready >= nworkers:
+            ready = True
+            sd_notify('READY=1')
+        if reloadq is not None and not stopping:
+            # Go on with the next worker when the previous one is done, exited, or is too slow
+            if reloading and (reloading[0] not in children or
+                              time.monotonic() - reloading[1] > 60):
+                reloading = None
+            while reloading is None and reloadq:
+                pid = reloadq.pop(0)
+                if pid in children:
+                    os.kill(pid, signal.SIGHUP)
+                    reloading = (pid, time.monotonic())
+            if reloading is None:
+                reloadq = None
+                sd_notify('READY=1')
+        if interval and ready and not stopping:
+            now = time.monotonic()
+            # A worker which did not report for 3 intervals after its warm-up is hung: kill it,
+            # it will be restarted
+            for pid, last in list(lastok.items()):
+                if now - last > 3 * interval:
+                    webui.msg("Worker %d is not responding, killing it" % pid)
+                    del lastok[pid]
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except OSError:
+                        pass
+            # We are fine if all the running workers reported recently
+            if lastok and all(now - last < 2 * interval for last in lastok.values()):
+                sd_notify('WATCHDOG=1')
+#}}}
+
+serve_options = {k: v for k, v in options.items() if k not in
+                 ('host', 'port', 'unix_socket', 'unix_socket_perms')}
+sockets = activated_sockets()
+if workers > 1:
+    serve_workers(workers, sockets)
+else:
+    if sockets:
+        options = dict(serve_options, sockets=sockets)
+    elif 'unix_socket' not in options:
+        options['host'] = args.addr
+        options['port'] = args.port
+    webui.warmup(args.warmup_log, args.warmup_queries)
+    interval = watchdog_interval()
+    if interval:
+        start_health_thread(interval, lambda: sd_notify('WATCHDOG=1'))
+    on_sighup(lambda: sd_notify('READY=1'), sd_reloading)
+    sd_notify('READY=1')
+    serve(webui.bottle.default_app(), **options)
 
 # vim: foldmethod=marker:filetype=python:textwidth=80:ts=4:et
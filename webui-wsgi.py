@@ -16,3 +16,13 @@ import os
 os.chdir(os.path.dirname(__file__))
 import webui
 application = webui.bottle.default_app()
+
+#
+# Prepare the process before the first request (compile templates, open the index, build the
+# folder tree). This runs when the script is loaded, so preload it when the daemon process starts
+# (WSGIImportScript, or process-group and application-group on WSGIScriptAlias) to keep the cost
+# away from the users. Set RECOLL_WEBUI_NOWARMUP to skip. A RECOLL_CONFDIR set with SetEnv is
+# only known when a request comes, so the index is warmed only if it is set in the environment
+# (e.g. above).
+if not os.environ.get('RECOLL_WEBUI_NOWARMUP'):
+    webui.warmup(index='RECOLL_CONFDIR' in os.environ)
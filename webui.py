@@ -1,27 +1,41 @@
 #{{{ imports
+# Modules only needed by some requests (JSON/CSV/zip exports, document extraction, searching) are
+# imported where they are used, so that starting a server process stays fast. See
+# bench/startup_bench.py.
 import os
 import bottle
 import time
 import sys
 import datetime
-import glob
 import hashlib
-import csv
-import io
 import string
 import shlex
+import functools
+import contextlib
+import types
+import mimetypes
+import shutil
+import tempfile
+import threading
 from urllib.parse import quote as urlquote
-from recoll import recoll, rclextract, rclconfig
+from recoll import rclconfig
 
 def msg(s):
     print("%s" % s, file=sys.stderr)
 
-# use ujson if avalaible (faster than built in json)
-try:
-    import ujson as json
-except ImportError:
-    import json
-    #msg("ujson module not found, using (slower) built-in json module instead")
+# use ujson if avalaible (faster than built in json). Imported on first use, and kept: a failed
+# import is not cached by Python.
+_g_json = None
+def json_module():
+    global _g_json
+    if _g_json is None:
+        try:
+            import ujson as json
+        except ImportError:
+            import json
+            #msg("ujson module not found, using (slower) built-in json module instead")
+        _g_json = json
+    return _g_json
 
 g_fscharset=sys.getfilesystemencoding()
 
@@ -120,6 +134,19 @@ def get_topdirs(confdir):
     rclconf = rclconfig.RclConfig(confdir)
     return rclconf.getConfParam('topdirs')
 
+# Server-level parameters from recoll.conf (e.g. webui_threads), used by webui-standalone.py. These
+# don't depend on a request, so they can be read before the server starts. recoll.conf is read
+# again on reload().
+def get_server_param(name):
+    return current_state().param(name)
+
+# Extra indexes: from the environment (RECOLL_EXTRACONFDIRS), else from webui_extraconfdirs
+def get_extraconfdirs(rclconf):
+    extraconfdirs = safe_envget('RECOLL_EXTRACONFDIRS')
+    if not extraconfdirs:
+        extraconfdirs = rclconf.getConfParam('webui_extraconfdirs')
+    return shlex.split(extraconfdirs) if extraconfdirs else []
+
 # Environment fetch for the cases where we don't care if unset or null
 def safe_envget(varnm):
     try:
@@ -147,6 +174,513 @@ def get_dbdir(confdir):
     return os.path.normpath(dbdir).encode(g_fscharset)
 
 #}}}
+#{{{ stage timers
+# The time spent in the stages of a request (config, db, execute, fetch, abstract, render...) is
+# added up in the request environ and sent in a Server-Timing header, which browser developer
+# tools display. Streamed responses (exports, zip) only report what happened before they started.
+def add_stage_time(name, secs):
+    try:
+        environ = bottle.request.environ
+    except RuntimeError:
+        return
+    timings = environ.setdefault('webui.timings', {})
+    timings[name] = timings.get(name, 0.0) + secs
+
+# Context manager or decorator timing a stage
+@contextlib.contextmanager
+def stage(name):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_stage_time(name, time.perf_counter() - t0)
+
+# Stage times for the current request, in milliseconds, with the total so far
+def stage_times(environ=None):
+    environ = environ or bottle.request.environ
+    out = {k: v * 1000 for k, v in environ.get('webui.timings', {}).items()}
+    out['total'] = (time.monotonic() - environ['webui.start']) * 1000
+    return out
+
+@bottle.hook('after_request')
+def add_server_timing():
+    if 'webui.start' in bottle.request.environ:
+        bottle.response.headers['Server-Timing'] = ', '.join(
+            '%s;dur=%.1f' % (k, v) for k, v in stage_times().items())
+
+class _OnClose:
+    """Wrap a streamed response body to call done() when it is finished or closed, even if it
+    was never started"""
+    def __init__(self, it, done):
+        self.it = it
+        self.done = done
+    def __iter__(self):
+        try:
+            yield from self.it
+        finally:
+            self.close()
+    def close(self):
+        done, self.done = self.done, None
+        if done:
+            try:
+                self.it.close()
+            finally:
+                done()
+    def __del__(self):
+        self.close()
+
+# Same as bottle.view(), timing the template rendering
+def view(tpl_name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            result = func(*args, **kwargs)
+            if not isinstance(result, dict):
+                return result
+            with stage('render'):
+                out = bottle.template(tpl_name, **result)
+            bottle.request.environ['webui.bytes'] = len(out.encode('utf-8'))
+            return out
+        return wrapper
+    return decorator
+#}}}
+#{{{ metrics
+# Request counts and latencies by route, exported with the server gauges on /metrics in the
+# Prometheus text format. A request is counted when its response is complete, which for streamed
+# responses (exports, zip) is after the body is sent.
+_g_latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+_g_nres_buckets = (0, 1, 10, 100, 1000, 10000, 100000)
+
+class Histogram:
+    """Counts per bucket, made cumulative when exported. Not locked: see Metrics."""
+    def __init__(self, buckets):
+        # Not imported in observe(), which may run while the interpreter shuts down
+        import bisect
+        self.bisect_left = bisect.bisect_left
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[self.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def copy(self):
+        h = Histogram(self.buckets)
+        h.counts = list(self.counts)
+        h.sum = self.sum
+        return h
+
+class Metrics:
+    """The request counters. They are updated once per request under a single lock, the gauges
+    are only computed when /metrics is requested."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inflight = 0
+        self.requests = {}
+        self.latency = {}
+        self.nres = Histogram(_g_nres_buckets)
+
+    def request_started(self):
+        with self.lock:
+            self.inflight += 1
+
+    def request_done(self, route, code, secs):
+        with self.lock:
+            self.inflight -= 1
+            key = (route, code)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            hist = self.latency.get(route)
+            if hist is None:
+                hist = self.latency[route] = Histogram(_g_latency_buckets)
+            hist.observe(secs)
+
+    def search_done(self, nres):
+        with self.lock:
+            self.nres.observe(nres)
+
+    def snapshot(self):
+        with self.lock:
+            return (self.inflight, dict(self.requests),
+                    {k: v.copy() for k, v in self.latency.items()}, self.nres.copy())
+
+_g_metrics = Metrics()
+
+# Route label: the fixed part of the route rule, e.g. /preview for /preview/<resnum:int>
+def route_name(environ):
+    route = environ.get('bottle.route')
+    if route is None:
+        return 'none'
+    return '/' + route.rule.split('/')[1].split('<')[0].split(':')[0]
+
+@bottle.hook('after_request')
+def count_request():
+    environ = bottle.request.environ
+    if 'webui.start' not in environ:
+        return
+    route, code = route_name(environ), bottle.response.status_code
+    # For an unhandled exception, the hook runs before bottle makes the 500 response
+    if sys.exc_info()[0] is not None:
+        code = 500
+    if environ.get('webui.streamed'):
+        # Counted by streamed_body() when done
+        environ['webui.route'] = (route, code)
+        return
+    request_done(environ, route, code)
+
+# Wrap a streamed response body, so that the request is counted when it is done
+def streamed_body(it):
+    environ = bottle.request.environ
+    environ['webui.streamed'] = True
+    def done():
+        route, code = environ.get('webui.route', (route_name(environ), 200))
+        request_done(environ, route, code)
+    return _OnClose(_count_bytes(it, environ), done)
+
+def _count_bytes(it, environ):
+    n = 0
+    try:
+        for chunk in it:
+            n += len(chunk) if isinstance(chunk, bytes) else len(chunk.encode('utf-8'))
+            yield chunk
+    finally:
+        environ['webui.bytes'] = n
+        it.close()
+
+def request_done(environ, route, code):
+    secs = time.monotonic() - environ['webui.start']
+    _g_metrics.request_done(route, code, secs)
+    if 'webui.search' in environ:
+        log_search(environ, route, code, secs)
+
+def _labels(**kw):
+    if not kw:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                             for k, v in kw.items())
+
+def _bound(b):
+    return '+Inf' if b == float('inf') else repr(b)
+
+class _Exposition:
+    def __init__(self):
+        self.lines = []
+
+    def metric(self, name, mtype, help, samples):
+        self.lines.append('# HELP %s %s' % (name, help))
+        self.lines.append('# TYPE %s %s' % (name, mtype))
+        for labels, value in samples:
+            self.lines.append('%s%s %s' % (name, _labels(**labels), value))
+
+    def histogram(self, name, help, hists):
+        self.lines.append('# HELP %s %s' % (name, help))
+        self.lines.append('# TYPE %s histogram' % name)
+        for labels, h in hists:
+            count = 0
+            for b, c in zip(h.buckets + (float('inf'),), h.counts):
+                count += c
+                self.lines.append('%s_bucket%s %d' % (name, _labels(**labels, le=_bound(b)), count))
+            self.lines.append('%s_sum%s %s' % (name, _labels(**labels), h.sum))
+            self.lines.append('%s_count%s %d' % (name, _labels(**labels), count))
+
+    def text(self):
+        return '\n'.join(self.lines) + '\n'
+
+def _ratio(hits, misses):
+    return hits / (hits + misses) if hits + misses else 0
+
+# The metrics of this process, in the Prometheus text format
+def metrics_text():
+    out = _Exposition()
+    inflight, requests, latency, nres = _g_metrics.snapshot()
+    out.metric('webui_requests_total', 'counter', 'Completed requests by route and status code',
+               [({'route': r, 'code': c}, n) for (r, c), n in sorted(requests.items())])
+    out.histogram('webui_request_duration_seconds', 'Request duration, including streaming',
+                  [({'route': r}, h) for r, h in sorted(latency.items())])
+    out.metric('webui_requests_in_flight', 'gauge', 'Requests in progress', [({}, inflight)])
+    out.histogram('webui_search_results', 'Number of results of the searches',
+                  [({}, nres)])
+
+    state = current_state()
+    pool = get_dbpool(state)
+    out.metric('webui_dbpool_idle', 'gauge', 'Idle index connections in the pool',
+               [({}, pool.size())])
+    out.metric('webui_dbpool_opened_total', 'counter', 'Index connections opened',
+               [({}, pool.created)])
+    out.metric('webui_dbpool_reused_total', 'counter', 'Index connections reused from the pool',
+               [({}, pool.reused)])
+    openq = get_openqueries(state)
+    if openq:
+        out.metric('webui_open_queries', 'gauge', 'Executed queries kept open for the next pages',
+                   [({}, openq.size())])
+        out.metric('webui_open_queries_reused_total', 'counter',
+                   'Searches continued from an open query', [({}, openq.reused)])
+    snaps = get_snapshots(state)
+    if snaps:
+        out.metric('webui_result_snapshots', 'gauge', 'Result snapshots kept',
+                   [({}, snaps.size())])
+        out.metric('webui_result_snapshot_hits_total', 'counter',
+                   'Previews and downloads of a result found in a snapshot', [({}, snaps.hits)])
+    out.metric('webui_dirs_cache_hit_ratio', 'gauge', 'Folder tree cache hit ratio',
+               [({}, _ratio(state.dirshits, state.dirsmisses))])
+    cache = state.extractcache
+    if cache:
+        out.metric('webui_extract_cache_bytes', 'gauge', 'Size of the extracted documents cache',
+                   [({}, cache.total)])
+        out.metric('webui_extract_cache_hit_ratio', 'gauge',
+                   'Extracted documents cache hit ratio', [({}, _ratio(cache.hits, cache.misses))])
+    epool = state.extractpool
+    if epool:
+        stats = epool.stats()
+        out.metric('webui_extract_workers', 'gauge', 'Extraction worker processes',
+                   [({'state': 'busy'}, stats['busy']),
+                    ({'state': 'idle'}, stats['workers'] - stats['busy'])])
+        out.metric('webui_extract_waiting', 'gauge', 'Extractions waiting for a worker',
+                   [({}, stats['waiting'])])
+        out.metric('webui_extract_failures_total', 'counter', 'Failed extractions',
+                   [({'reason': 'timeout'}, stats['timeouts']),
+                    ({'reason': 'error'}, stats['failures'])])
+    lanes = [get_lane(name) for name in _g_lanes_params]
+    lanes = [lane for lane in lanes if lane]
+    if lanes:
+        out.metric('webui_lane_active', 'gauge', 'Requests executing in an admission lane',
+                   [({'lane': l.name}, l.active) for l in lanes])
+        out.metric('webui_lane_waiting', 'gauge', 'Requests waiting in an admission lane',
+                   [({'lane': l.name}, l.waiting) for l in lanes])
+        out.metric('webui_lane_rejected_total', 'counter', 'Requests rejected by a full lane',
+                   [({'lane': l.name, 'reason': 'full'}, l.rejected) for l in lanes] +
+                   [({'lane': l.name, 'reason': 'timeout'}, l.timeouts) for l in lanes])
+    out.metric('webui_querylog_records_total', 'counter', 'Query log records',
+               [({'result': 'written'}, _g_querylog.written),
+                ({'result': 'dropped'}, _g_querylog.dropped)])
+    out.metric('webui_searches_total', 'counter', 'Result page searches executed, or coalesced '
+               'with an identical one in progress',
+               [({'type': 'executed'}, _g_searchflight.executions),
+                ({'type': 'coalesced'}, _g_searchflight.coalesced)])
+    return out.text()
+#}}}
+#{{{ query log
+class QueryLog:
+    """JSON lines log of the searches. The records are written by a background thread, so that
+    the requests never wait for the disk. If the queue is full, records are dropped (and
+    counted)."""
+    def __init__(self, maxqueue=10000):
+        self.maxqueue = maxqueue
+        self.lock = threading.Lock()
+        self.queue = None
+        self.pid = None
+        self.reopen = False
+        self.written = 0
+        self.dropped = 0
+
+    # path: the log file, or None for stderr
+    def write(self, path, record):
+        import queue
+        # Threads don't survive a fork: start ours in the process which logs
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.queue = queue.Queue(self.maxqueue)
+                    threading.Thread(target=self._run, args=(self.queue,), daemon=True).start()
+                    self.pid = os.getpid()
+        try:
+            self.queue.put_nowait((path, record))
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self, q):
+        import queue
+        json = json_module()
+        f = None
+        fpath = None
+        while True:
+            items = [q.get()]
+            while True:
+                try:
+                    items.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            for path, record in items:
+                if f is None or path != fpath or self.reopen:
+                    self.reopen = False
+                    if f and f is not sys.stderr:
+                        f.close()
+                    fpath = path
+                    try:
+                        f = open(path, 'a', encoding='utf-8') if path else sys.stderr
+                    except OSError as ex:
+                        msg("Query log: can't open %s: %s" % (path, ex))
+                        f = None
+                if f is None:
+                    self.dropped += 1
+                    continue
+                f.write(json.dumps(record) + '\n')
+                self.written += 1
+            if f:
+                f.flush()
+
+_g_querylog = QueryLog()
+
+# Query log file (webui_querylog, None for stderr) and slow query threshold in seconds
+# (webui_slowquery, 0 for none)
+def querylog_config(state):
+    if state.querylog is None:
+        val = state.param('slowquery')
+        state.querylog = (state.param('querylog') or None, float(val) if val else 0)
+    return state.querylog
+
+# Record the search done by the current request, for the query log
+def note_search(q, config, nres, cache, truncated=False):
+    bottle.request.environ['webui.search'] = {
+        'query': query_to_recoll_string(q), 'dir': q['dir'], 'sort': q['sort'],
+        'ascending': q['ascending'], 'page': q['page'], 'nres': nres, 'cache': cache,
+        'truncated': truncated, 'logquery': config['logquery']}
+
+# Called when a request which did a search is complete. All searches are logged if webui_querylog
+# or webui_logquery are set, else only the slow ones.
+def log_search(environ, route, code, secs):
+    path, slow = querylog_config(environ.get('webui.state') or current_state())
+    search = environ['webui.search']
+    isslow = slow > 0 and secs >= slow
+    if not (search.pop('logquery') or path or isslow):
+        return
+    record = {'time': datetime.datetime.now().astimezone().isoformat(timespec='milliseconds'),
+              'route': route, 'status': code}
+    record.update(search)
+    if environ.get('webui.truncated'):
+        record['truncated'] = True
+    if environ.get('webui.disconnected'):
+        record['disconnected'] = True
+    if environ.get('REMOTE_USER'):
+        record['user'] = environ['REMOTE_USER']
+    record['bytes'] = environ.get('webui.bytes')
+    record['ms'] = {k: round(v, 1) for k, v in stage_times(environ).items()}
+    if isslow:
+        record['slow'] = True
+        record['xquery'] = environ.get('webui.xquery')
+    _g_querylog.write(path, record)
+#}}}
+#{{{ conditional and range requests
+# Last modification time for a document, as an int. Embedded documents get the container's.
+def doc_mtime(doc):
+    for f in ('fmtime', 'dmtime', 'mtime'):
+        try:
+            v = getattr(doc, f)
+        except Exception:
+            v = None
+        if v:
+            try:
+                return int(v.strip(','))
+            except ValueError:
+                pass
+    return 0
+
+# Entity tag for a document. The sig field changes whenever the (container) file is modified, so
+# this identifies the content without having to extract it.
+def doc_etag(doc):
+    try:
+        ident = doc['rcludi']
+    except Exception:
+        ident = (doc.url or '') + '|' + (doc.ipath or '')
+    sig = doc.sig or str(doc_mtime(doc))
+    return '"%s"' % hashlib.sha1((ident + '|' + sig).encode('utf-8', 'surrogateescape')).hexdigest()
+
+def _etag_match(header, etag, weak=True):
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    for tag in header.split(','):
+        tag = tag.strip()
+        if weak and tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+# Check If-None-Match/If-Modified-Since. Returns True if a 304 should be sent. If-None-Match takes
+# precedence when present (RFC 9110 13.2.2)
+def not_modified(etag, mtime):
+    inm = bottle.request.environ.get('HTTP_IF_NONE_MATCH')
+    if inm:
+        return _etag_match(inm, etag)
+    ims = bottle.request.environ.get('HTTP_IF_MODIFIED_SINCE')
+    if ims and mtime:
+        ims = bottle.parse_date(ims.split(";")[0].strip())
+        return ims is not None and ims >= mtime
+    return False
+
+# Decide if the Range header should be honoured: If-Range must match the current version,
+# and only strong comparison is allowed
+def range_applies(etag, mtime):
+    ifrange = bottle.request.environ.get('HTTP_IF_RANGE')
+    if not ifrange:
+        return True
+    ifrange = ifrange.strip()
+    if ifrange.startswith('"') or ifrange.startswith('W/'):
+        return _etag_match(ifrange, etag, weak=False)
+    date = bottle.parse_date(ifrange)
+    return date is not None and mtime and date == mtime
+
+def _file_range_iter(f, ranges, bufsize=1024*1024):
+    # ranges is a list of (prefix bytes, start, end) tuples, end not inclusive
+    try:
+        for prefix, start, end in ranges:
+            if prefix:
+                yield prefix
+            f.seek(start)
+            left = end - start
+            while left > 0:
+                data = f.read(min(left, bufsize))
+                if not data:
+                    break
+                left -= len(data)
+                yield data
+    finally:
+        f.close()
+
+# Send an open file, honouring the Range header. Single ranges get a plain 206, multiple ranges a
+# multipart/byteranges body. The file is closed when the response is done.
+def send_file_ranges(f, size, etag, mtime, content_type):
+    headers = bottle.response.headers
+    headers['Accept-Ranges'] = 'bytes'
+    headers['ETag'] = etag
+    if mtime:
+        headers['Last-Modified'] = bottle.http_date(mtime)
+    rheader = bottle.request.environ.get('HTTP_RANGE')
+    # Other range units are ignored (RFC 9110 14.2)
+    if rheader and not rheader.strip().lower().startswith('bytes='):
+        rheader = None
+    if not rheader or not range_applies(etag, mtime):
+        headers['Content-Length'] = str(size)
+        return _file_range_iter(f, [(b'', 0, size)])
+    ranges = list(bottle.parse_range_header(rheader, size))
+    if not ranges:
+        f.close()
+        headers['Content-Range'] = 'bytes */%d' % size
+        bottle.response.status = 416
+        return ''
+    bottle.response.status = 206
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end - 1, size)
+        headers['Content-Length'] = str(end - start)
+        return _file_range_iter(f, [(b'', start, end)])
+    boundary = hashlib.sha1(('%s%f' % (etag, time.time())).encode('ascii')).hexdigest()
+    parts = []
+    clen = 0
+    for start, end in ranges:
+        prefix = ('\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' %
+                  (boundary, content_type, start, end - 1, size)).encode('latin1')
+        parts.append((prefix, start, end))
+        clen += len(prefix) + end - start
+    trailer = ('\r\n--%s--\r\n' % boundary).encode('latin1')
+    parts.append((trailer, 0, 0))
+    clen += len(trailer)
+    headers['Content-Type'] = 'multipart/byteranges; boundary=%s' % boundary
+    headers['Content-Length'] = str(clen)
+    return _file_range_iter(f, parts)
+#}}}
 def commonpathprefix(paths):
     if len(paths) == 0:
         return ""
@@ -166,6 +700,7 @@ def commonpathprefix(paths):
     return "/" + "/".join(common) + "/"
 
 #{{{ get_config
+@stage('config')
 def get_config():
     # Arrange for apache wsgi SetEnv values to be reflected in the os environment.
     # This allows people to use either method
@@ -181,9 +716,9 @@ def get_config():
     config['dirs'] = dict.fromkeys(topdirs, config['confdir'])
     config['commonprefix'] = commonpathprefix(topdirs)
     # add topdirs from extra config dirs
-    extraconfdirs = safe_envget('RECOLL_EXTRACONFDIRS')
+    extraconfdirs = get_extraconfdirs(rclconf)
     if extraconfdirs:
-        config['extraconfdirs'] = shlex.split(extraconfdirs)
+        config['extraconfdirs'] = extraconfdirs
         for e in config['extraconfdirs']:
             config['dirs'].update(dict.fromkeys([os.path.expanduser(d) for d in
                 shlex.split(get_topdirs(e))],e))
@@ -229,6 +764,11 @@ def get_config():
     val = 0 if val is None else int(val)
     config['rclc_nojsoncsv'] = val
 
+    val = rclconf.getConfParam('webui_nozip')
+    config['rclc_nozip'] = 0 if val is None else int(val)
+    val = rclconf.getConfParam('webui_zipmaxfiles')
+    config['rclc_zipmaxfiles'] = 500 if val is None else int(val)
+
     val = rclconf.getConfParam('webui_maxperpage')
     val = 0 if val is None else int(val)
     if val:
@@ -239,6 +779,39 @@ def get_config():
     val = 0 if val is None else int(val)
     config['rclc_nosettings'] = val
 
+    # Cache for extracted embedded documents (attachments, archive members). Size in MB, 0 to
+    # disable
+    val = rclconf.getConfParam('webui_extractcachesize')
+    config['rclc_extractcachesize'] = 0 if val is None else int(val)
+    val = rclconf.getConfParam('webui_extractcachedir')
+    if not val:
+        val = os.path.join(tempfile.gettempdir(), 'recoll-webui-%d' % os.getuid(), 'extract')
+    config['rclc_extractcachedir'] = os.path.expanduser(val)
+
+    # Extraction worker processes for preview and download. 0: extract inside the server
+    val = rclconf.getConfParam('webui_extractworkers')
+    config['rclc_extractworkers'] = 0 if val is None else int(val)
+    val = rclconf.getConfParam('webui_extracttimeout')
+    config['rclc_extracttimeout'] = 60 if val is None else int(val)
+    val = rclconf.getConfParam('webui_extractmemory')
+    config['rclc_extractmemory'] = 0 if val is None else int(val)
+
+    # Time limit in seconds for fetching the results of a search. 0 for no limit
+    val = rclconf.getConfParam('webui_querytimeout')
+    config['rclc_querytimeout'] = 0 if val is None else float(val)
+
+    # Show the time spent in each stage of the search under the results
+    val = rclconf.getConfParam('webui_showtimings')
+    config['rclc_showtimings'] = 0 if val is None else int(val)
+
+    # Result counts from this value on are displayed as estimates. 0 to always show the count
+    val = rclconf.getConfParam('webui_approxcount')
+    config['rclc_approxcount'] = 0 if val is None else int(val)
+
+    # How long the folder tree is kept before walking the file system again
+    val = rclconf.getConfParam('webui_dircachetime')
+    config['rclc_dircachetime'] = 300 if val is None else int(val)
+
     val = str(rclconf.getConfParam('webui_defaultsort'))
     config['defsortidx'] = 0
     for i in range(len(SORTS)):
@@ -248,7 +821,27 @@ def get_config():
     return config
 #}}}
 #{{{ get_dirs
-def get_dirs(tops, depth):
+# The folder tree is cached for maxage seconds: walking it can be slow on big data sets.
+@stage('dirs')
+def get_dirs(tops, depth, maxage=0):
+    state = current_state()
+    key = (tuple(tops), depth)
+    now = time.monotonic()
+    if maxage > 0:
+        with state.lock:
+            entry = state.dirscache.get(key)
+            if entry and now - entry[0] < maxage:
+                state.dirshits += 1
+                return entry[1]
+            state.dirsmisses += 1
+    dirs = _walk_dirs(tops, depth)
+    if maxage > 0:
+        with state.lock:
+            state.dirscache[key] = (now, dirs)
+    return dirs
+
+def _walk_dirs(tops, depth):
+    import glob
     v = []
     for top in tops:
         # We do the conversion to bytes here, because Python versions
@@ -282,6 +875,10 @@ def get_query(config=None):
     }
     if bottle.request.query.rcludi:
         query['rcludi'] = bottle.request.query.rcludi
+    if bottle.request.query.cursor:
+        query['cursor'] = bottle.request.query.cursor
+    if bottle.request.query.snap:
+        query['snap'] = bottle.request.query.snap
     #msg("query['query'] : %s" % query['query'])
     return query
 #}}}
@@ -295,8 +892,919 @@ def query_to_recoll_string(q):
         qs += " dir:\"%s\" " % qdir
     return qs
 #}}}
+#{{{ extracted documents cache
+class ExtractCache:
+    """Size-bounded directory of extracted embedded documents, keyed by udi and container
+    signature. Entries are created by atomic rename, so readers never see a partial file, and an
+    open file stays valid if the entry is evicted. The file mtimes are the LRU order, which makes
+    the accounting correct when several processes share the directory."""
+    def __init__(self, dir, maxbytes):
+        self.dir = dir
+        self.maxbytes = maxbytes
+        self.lock = threading.Lock()
+        self._makedir()
+        self.total = sum(sz for _, sz, _ in self._entries())
+        self.hits = 0
+        self.misses = 0
+
+    # The cache has the documents' contents, and the default location is in the shared temporary
+    # directory: refuse a directory (or parent) which another user created or could write to.
+    def _makedir(self):
+        import stat
+        parent = os.path.dirname(os.path.abspath(self.dir))
+        os.makedirs(parent, mode=0o700, exist_ok=True)
+        os.makedirs(self.dir, mode=0o700, exist_ok=True)
+        uid = os.geteuid()
+        st = os.lstat(parent)
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid not in (uid, 0) or st.st_mode & 0o022:
+            raise OSError('%s is not a private directory' % parent)
+        st = os.lstat(self.dir)
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != uid:
+            raise OSError('%s is not a private directory' % self.dir)
+        if st.st_mode & 0o077:
+            os.chmod(self.dir, 0o700)
+
+    def _entries(self):
+        out = []
+        with os.scandir(self.dir) as it:
+            for e in it:
+                if e.name.startswith('.'):
+                    continue
+                try:
+                    st = e.stat()
+                except OSError:
+                    continue
+                out.append((st.st_mtime, st.st_size, e.path))
+        return out
+
+    # The extension is kept so that the file name is still usable as a download name
+    def key(self, doc):
+        h = hashlib.sha1((doc['rcludi'] + '|' + (doc.sig or '')).encode(
+            'utf-8', 'surrogateescape')).hexdigest()
+        return h + (mimetypes.guess_extension(doc.mimetype or '') or '')
+
+    # Return an open file for the entry, or None
+    def get(self, key):
+        path = os.path.join(self.dir, key)
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return f
+
+    # Move an extracted temporary file into the cache and return an open file for it. The
+    # temporary file is consumed in all cases: if it can't be stored, it is returned open and
+    # unlinked.
+    def put(self, key, tmppath):
+        size = os.stat(tmppath).st_size
+        if size > self.maxbytes // 4:
+            # Not worth flushing a big part of the cache for a single entry
+            return open_unlinked(tmppath)
+        path = os.path.join(self.dir, key)
+        staging = os.path.join(self.dir, '.%s.%d.%d' % (key, os.getpid(), threading.get_ident()))
+        current = tmppath
+        try:
+            try:
+                os.rename(tmppath, staging)
+            except OSError:
+                # Different file system
+                shutil.copyfile(tmppath, staging)
+                try:
+                    os.unlink(tmppath)
+                except OSError:
+                    pass
+            current = staging
+            os.rename(staging, path)
+        except OSError as ex:
+            msg("Extract cache: could not store %s: %s" % (key, ex))
+            if current != staging:
+                try:
+                    os.unlink(staging)
+                except OSError:
+                    pass
+            return open_unlinked(current)
+        f = open(path, 'rb')
+        with self.lock:
+            self.total += size
+            if self.total > self.maxbytes:
+                self._evict()
+        return f
+
+    def _evict(self):
+        # Rescan: other processes may have added or removed entries.
+        entries = sorted(self._entries())
+        total = sum(sz for _, sz, _ in entries)
+        target = self.maxbytes * 9 // 10
+        for _, sz, path in entries:
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+                total -= sz
+            except OSError:
+                pass
+        self.total = total
+
+def get_extractcache(config):
+    if config['rclc_extractcachesize'] <= 0:
+        return None
+    state = current_state()
+    with state.lock:
+        cache = state.extractcache
+        if cache is None or cache.dir != config['rclc_extractcachedir']:
+            try:
+                cache = ExtractCache(config['rclc_extractcachedir'],
+                                     config['rclc_extractcachesize'] * 1024 * 1024)
+            except OSError as ex:
+                msg("Extract cache: can't use %s: %s" % (config['rclc_extractcachedir'], ex))
+                return None
+            state.extractcache = cache
+        return cache
+#}}}
+#{{{ extraction worker pool
+class ExtractTimeout(Exception):
+    pass
+
+class _ExtractWorker:
+    def __init__(self, memlimit):
+        import subprocess
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'extractworker.py')
+        self.proc = subprocess.Popen([sys.executable, script, str(memlimit)],
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def _read(self, n, deadline):
+        from select import select as fdselect
+        fd = self.proc.stdout.fileno()
+        data = b''
+        while len(data) < n:
+            left = deadline - time.monotonic()
+            if left <= 0 or not fdselect([fd], [], [], left)[0]:
+                raise ExtractTimeout()
+            chunk = os.read(fd, n - len(data))
+            if not chunk:
+                raise Exception('extraction worker exited with status %s' % self.proc.wait())
+            data += chunk
+        return data
+
+    def call(self, job, timeout):
+        import pickle
+        import struct
+        data = pickle.dumps(job)
+        self.proc.stdin.write(struct.pack('!I', len(data)) + data)
+        self.proc.stdin.flush()
+        deadline = time.monotonic() + timeout
+        n = struct.unpack('!I', self._read(4, deadline))[0]
+        status, res = pickle.loads(self._read(n, deadline))
+        if status != 'ok':
+            raise Exception(res)
+        return res
+
+    def kill(self):
+        try:
+            self.proc.kill()
+            self.proc.wait()
+        except Exception:
+            pass
+
+class ExtractPool:
+    """A bounded set of extractworker.py processes. Jobs wait for an idle worker, a worker which
+    exceeds the timeout is killed and replaced. waiting is the current queue depth."""
+    def __init__(self, nworkers, timeout, memlimit):
+        self.nworkers = nworkers
+        self.timeout = timeout
+        self.memlimit = memlimit
+        self.cond = threading.Condition()
+        self.idle = []
+        self.closed = False
+        self.nstarted = 0
+        self.waiting = 0
+        self.jobs = 0
+        self.timeouts = 0
+        self.failures = 0
+
+    def _acquire(self):
+        with self.cond:
+            self.waiting += 1
+            try:
+                while not self.idle and self.nstarted >= self.nworkers:
+                    self.cond.wait()
+                if self.idle:
+                    return self.idle.pop()
+                self.nstarted += 1
+            finally:
+                self.waiting -= 1
+        try:
+            return _ExtractWorker(self.memlimit)
+        except Exception:
+            self._release(None)
+            raise
+
+    def _release(self, worker):
+        with self.cond:
+            if worker and not self.closed:
+                self.idle.append(worker)
+                worker = None
+            else:
+                self.nstarted -= 1
+            self.cond.notify()
+        if worker:
+            worker.kill()
+
+    def run(self, job):
+        worker = self._acquire()
+        ok = False
+        try:
+            res = worker.call(job, self.timeout)
+            ok = True
+            return res
+        except ExtractTimeout:
+            self.timeouts += 1
+            raise
+        except Exception:
+            # The worker state is unknown (crashed, or error in the middle of the exchange)
+            self.failures += 1
+            raise
+        finally:
+            self.jobs += 1
+            if not ok:
+                worker.kill()
+                worker = None
+            self._release(worker)
+
+    def stats(self):
+        with self.cond:
+            return {'workers': self.nstarted, 'busy': self.nstarted - len(self.idle),
+                    'waiting': self.waiting, 'jobs': self.jobs, 'timeouts': self.timeouts,
+                    'failures': self.failures}
+
+    # Stop the idle workers now, and the busy ones when their job is done
+    def close(self):
+        with self.cond:
+            self.closed = True
+            idle, self.idle = self.idle, []
+            self.nstarted -= len(idle)
+        for worker in idle:
+            worker.kill()
+
+def get_extractpool(config):
+    if config['rclc_extractworkers'] <= 0:
+        return None
+    state = current_state()
+    with state.lock:
+        if state.extractpool is None:
+            state.extractpool = ExtractPool(config['rclc_extractworkers'],
+                                            config['rclc_extracttimeout'],
+                                            config['rclc_extractmemory'] * 1024 * 1024)
+        return state.extractpool
+
+def _extract_job(op, doc, config):
+    fields = {}
+    for k in doc.keys():
+        try:
+            fields[k] = doc[k]
+        except Exception:
+            pass
+    try:
+        binurl = doc.getbinurl()
+    except Exception:
+        binurl = None
+    return {'op': op, 'confdir': config['confdir'], 'fields': fields, 'binurl': binurl}
+
+def _run_extract(pool, op, doc, config):
+    try:
+        return pool.run(_extract_job(op, doc, config))
+    except ExtractTimeout:
+        msg("Extraction timed out for %s" % doc.url)
+        bottle.abort(504, 'Document extraction timed out')
+    except Exception as ex:
+        msg("Extraction failed for %s: %s" % (doc.url, ex))
+        bottle.abort(500, 'Document extraction failed')
+
+# Extract the text for a document. Returns an object with text and mimetype attributes, like
+# rclextract.Extractor.textextract()
+@stage('extract')
+def extract_text(doc, config):
+    pool = get_extractpool(config)
+    if pool is None:
+        from recoll import rclextract
+        xt = rclextract.Extractor(doc)
+        return xt.textextract(doc.ipath)
+    text, mimetype = _run_extract(pool, 'text', doc, config)
+    return types.SimpleNamespace(text=text, mimetype=mimetype)
+
+# Extract a document to a temporary file and return its path
+@stage('extract')
+def extract_file(doc, config):
+    pool = get_extractpool(config)
+    if pool is None:
+        from recoll import rclextract
+        xt = rclextract.Extractor(doc)
+        return xt.idoctofile(doc.ipath, doc.mimetype)
+    return _run_extract(pool, 'file', doc, config)
+#}}}
+#{{{ doc_to_file
+# Extract a document to a file and return it open for reading. Top level documents are opened in
+# place. Embedded documents are served from the extracted documents cache when possible, others
+# are extracted to a temporary file which is unlinked right away.
+def doc_to_file(doc, config):
+    f = open_original(doc)
+    if f:
+        return f
+    cache = get_extractcache(config) if doc.ipath else None
+    if cache:
+        key = cache.key(doc)
+        f = cache.get(key)
+        if f:
+            return f
+    path = extract_file(doc, config)
+    if cache:
+        return cache.put(key, path)
+    return open_unlinked(path)
+
+# Open a temporary file for reading and unlink it
+def open_unlinked(path):
+    f = open(path, 'rb')
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+    return f
+
+# The original file of a top level document, open for reading, or None (embedded document,
+# non-file URL, file gone). Extracting it would just copy it, unless it is compressed: idoctofile()
+# uncompresses .gz, .bz2... files, so only files whose name gives the document type are used.
+def open_original(doc):
+    if doc.ipath:
+        return None
+    try:
+        binurl = doc.getbinurl()
+    except Exception:
+        return None
+    if not binurl.startswith(b'file://'):
+        return None
+    mtype, encoding = mimetypes.guess_type(os.fsdecode(binurl[7:]))
+    if encoding or mtype != doc.mimetype:
+        return None
+    try:
+        f = open(binurl[7:], 'rb')
+    except OSError:
+        return None
+    import stat
+    if not stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+        f.close()
+        return None
+    return f
+#}}}
+#{{{ server state
+class ServerState:
+    """What the server keeps between requests and derives from recoll.conf: server parameters,
+    Db pool, admission lanes, extraction pool and cache, folder tree cache. These are created on
+    first use. A request uses the state which was current when it started for its whole duration,
+    so that reload() can install a new state without disturbing the requests in progress."""
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.rclconf = None
+        self.dbpool = None
+        self.openqueries = None
+        self.snapshots = None
+        self.lanes = None
+        self.extractpool = None
+        self.extractcache = None
+        self.dirscache = {}
+        self.dirshits = 0
+        self.dirsmisses = 0
+        self.dbdirs = {}
+        self.main_index = None
+        self.querylog = None
+        # Last readiness check, as (time, ok)
+        self.ready = None
+        self.readylock = threading.Lock()
+
+    def param(self, name):
+        with self.lock:
+            if self.rclconf is None:
+                self.rclconf = rclconfig.RclConfig(safe_envget('RECOLL_CONFDIR'))
+            return self.rclconf.getConfParam('webui_' + name)
+
+    # Called once replaced: the connections and extraction workers still in use by the requests
+    # in progress are closed when they are given back.
+    def close(self):
+        with self.lock:
+            if self.dbpool:
+                self.dbpool.close()
+            if self.openqueries:
+                self.openqueries.close()
+            if self.extractpool:
+                self.extractpool.close()
+
+_g_state = ServerState()
+_g_reload_lock = threading.Lock()
+# get_config() updates DEFAULTS from recoll.conf
+_g_builtin_defaults = dict(DEFAULTS)
+
+# The state of the current request, or the current state outside of a request
+def current_state():
+    try:
+        return bottle.request.environ['webui.state']
+    except (RuntimeError, KeyError):
+        return _g_state
+
+@bottle.hook('before_request')
+def mark_request_start():
+    environ = bottle.request.environ
+    environ['webui.start'] = time.monotonic()
+    _g_metrics.request_started()
+    # Already set by internal_request() when warming up a new state
+    environ.setdefault('webui.state', _g_state)
+
+# Replace the server state, reading recoll.conf again: changes to the webui_* parameters, to the
+# extra indexes or to the folders are taken into account. The new state is warmed up (see
+# warmup()) before it is installed, so that the following requests don't pay for it.
+def reload(logfile=None, nqueries=None, warm=True):
+    global _g_state
+    with _g_reload_lock:
+        tstart = time.monotonic()
+        DEFAULTS.update(_g_builtin_defaults)
+        state = ServerState()
+        if warm:
+            if not bottle.DEBUG and bottle.TEMPLATES:
+                compile_templates()
+            warmup(logfile, nqueries, state)
+        old, _g_state = _g_state, state
+        old.close()
+        # Reopen the query log file (log rotation)
+        _g_querylog.reopen = True
+        if warm:
+            msg("Reloaded in %.2f s" % (time.monotonic() - tstart))
+#}}}
+#{{{ db pool
+# Index generation: changes when the index is updated. We use the modification time of the Xapian
+# version file, which is rewritten on each commit.
+def index_generation(confdir, dbs):
+    dbdirs = current_state().dbdirs
+    dbdir = dbdirs.get(confdir)
+    if dbdir is None:
+        dbdir = dbdirs[confdir] = get_dbdir(confdir)
+    gen = []
+    for d in [dbdir] + list(dbs):
+        for fn in (b'iamglass', b'iamchert', b'iamhoney', b''):
+            try:
+                gen.append(os.stat(os.path.join(d, fn)).st_mtime_ns)
+                break
+            except OSError:
+                pass
+    return tuple(gen)
+
+class DbPool:
+    """Recoll Db connections kept open between requests. A connection is used by one request at a
+    time: it is leased by recoll_initsearch() and given back when the request is done (see
+    release_request_dbs()). Connections opened before the last index update are dropped so that
+    new requests see the current index."""
+    def __init__(self, maxidle):
+        self.maxidle = maxidle
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self, confdir, dbs, synonyms=None):
+        key = (confdir, tuple(dbs), synonyms)
+        gen = index_generation(confdir, dbs)
+        with self.lock:
+            entries = self.idle.get(key, [])
+            while entries:
+                db, dbgen = entries.pop()
+                if dbgen == gen:
+                    self.reused += 1
+                    return db, (key, gen)
+        from recoll import recoll
+        db = recoll.connect(confdir, extra_dbs=dbs)
+        if synonyms:
+            try:
+                db.setSynonymsFile(synonyms)
+            except:
+                # Only supported from recoll 1.40.3, just ignore the error for now
+                msg(f"Setting synonyms to [{synonyms}] failed")
+        with self.lock:
+            self.created += 1
+        return db, (key, gen)
+
+    def release(self, db, lease):
+        key, gen = lease
+        if self.maxidle <= 0:
+            return
+        with self.lock:
+            entries = self.idle.setdefault(key, [])
+            if len(entries) < self.maxidle:
+                entries.append((db, gen))
+
+    def size(self):
+        with self.lock:
+            return sum(len(v) for v in self.idle.values())
+
+    def clear(self):
+        with self.lock:
+            self.idle = {}
+
+    # Keep no more connections: the ones in use are dropped when given back
+    def close(self):
+        with self.lock:
+            self.maxidle = 0
+            self.idle = {}
+
+def get_dbpool(state=None):
+    state = state or current_state()
+    with state.lock:
+        if state.dbpool is None:
+            val = state.param('dbpoolsize')
+            state.dbpool = DbPool(4 if val is None else int(val))
+        return state.dbpool
+
+# Lease a Db for the current request. It will be returned to the pool by the after_request hook.
+def request_db(confdir, dbs, synonyms):
+    pool = get_dbpool()
+    with stage('db'):
+        db, lease = pool.acquire(confdir, dbs, synonyms)
+    bottle.request.environ.setdefault('webui.dbleases', []).append((pool, db, lease))
+    return db
+
+@bottle.hook('after_request')
+def release_request_dbs():
+    leases = bottle.request.environ.pop('webui.dbleases', None)
+    if leases:
+        for pool, db, lease in leases:
+            pool.release(db, lease)
+
+# Parameters for connecting to the main index (with the extra ones), outside of a request
+def main_index(state=None):
+    state = state or current_state()
+    with state.lock:
+        if state.main_index is None:
+            rclconf = rclconfig.RclConfig(safe_envget('RECOLL_CONFDIR'))
+            dbs = list(map(get_dbdir, get_extraconfdirs(rclconf)))
+            synonyms = state.param('synonyms') or None
+            state.main_index = (rclconf.getConfDir(), dbs, synonyms)
+        return state.main_index
+
+# Open a connection to the main index so that the first request does not pay for it.
+def warm_dbpool(state=None):
+    pool = get_dbpool(state)
+    db, lease = pool.acquire(*main_index(state))
+    pool.release(db, lease)
+#}}}
+#{{{ open queries
+class OpenQueries:
+    """Executed queries kept open with their Db between requests, by query fingerprint, so that
+    another page of the same search continues from where the previous one stopped, instead of
+    running the query again and skipping to the page offset. An entry is used by one request at a
+    time. Entries are given back to the Db pool when more than maxsize are kept, after maxage
+    seconds, and when the index has changed."""
+    def __init__(self, maxsize, maxage):
+        self.maxsize = maxsize
+        self.maxage = maxage
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.reused = 0
+        self.stored = 0
+
+    # Return (query, pool, db, lease) for the fingerprint, or None
+    def take(self, fp):
+        with self.lock:
+            entry = self.entries.pop(fp, None)
+        if entry is None:
+            return None
+        t, query, pool, db, lease = entry
+        (confdir, dbs, _), gen = lease
+        if time.monotonic() - t > self.maxage or index_generation(confdir, dbs) != gen:
+            pool.release(db, lease)
+            return None
+        with self.lock:
+            self.reused += 1
+        return query, pool, db, lease
+
+    def put(self, fp, query, pool, db, lease):
+        now = time.monotonic()
+        dropped = []
+        with self.lock:
+            if self.maxsize <= 0:
+                dropped.append((pool, db, lease))
+            else:
+                old = self.entries.pop(fp, None)
+                if old:
+                    dropped.append(old[2:])
+                self.entries[fp] = (now, query, pool, db, lease)
+                self.stored += 1
+                # Oldest first
+                for k, e in list(self.entries.items()):
+                    if len(self.entries) > self.maxsize or now - e[0] > self.maxage:
+                        dropped.append(e[2:])
+                        del self.entries[k]
+        for pool, db, lease in dropped:
+            pool.release(db, lease)
+
+    def size(self):
+        with self.lock:
+            return len(self.entries)
+
+    def close(self):
+        with self.lock:
+            self.maxsize = 0
+            entries, self.entries = self.entries, {}
+        for _, _, pool, db, lease in entries.values():
+            pool.release(db, lease)
+
+# None if disabled (webui_openqueries 0)
+def get_openqueries(state=None):
+    state = state or current_state()
+    with state.lock:
+        if state.openqueries is None:
+            val = state.param('openqueries')
+            maxsize = 8 if val is None else int(val)
+            val = state.param('openquerytime')
+            state.openqueries = OpenQueries(maxsize, 120 if val is None else float(val))
+        return state.openqueries if state.openqueries.maxsize > 0 else None
+
+# What determines the list of results of a search, whatever the page
+def query_fingerprint(q, config):
+    key = (config['confdir'], query_to_recoll_string(q), q['sort'], q['ascending'],
+           config['stem'], config['stemlang'], config['collapsedups'], config['synonyms'],
+           tuple(config['extraconfdirs'] or ()))
+    return hashlib.sha1(repr(key).encode('utf-8', 'surrogateescape')).hexdigest()[:16]
+
+# Cursor for the next and previous page links: the position of the first result of the page,
+# for a search (fingerprint) on an index version (generation). The page parameter is still used if
+# the cursor does not match, e.g. after an index update.
+def make_cursor(fp, pos, gen):
+    import base64
+    gen = hashlib.sha1(repr(gen).encode()).hexdigest()[:8]
+    return base64.urlsafe_b64encode(('%s.%d.%s' % (fp, pos, gen)).encode()).decode().rstrip('=')
+
+# Return the position from a cursor, or None if it doesn't match the search and the index
+def parse_cursor(cursor, fp, gen):
+    import base64
+    try:
+        cursor = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        cfp, pos, cgen = cursor.split('.')
+        pos = int(pos)
+    except ValueError:
+        return None
+    if cfp != fp or cgen != hashlib.sha1(repr(gen).encode()).hexdigest()[:8] or pos < 0:
+        return None
+    return pos
+#}}}
+#{{{ result snapshots
+class ResultSnapshots:
+    """The rcludi of the results shown for a search, by position, recorded as the pages are
+    produced. The page, preview, download and zip links refer to the snapshot by its id, so that
+    they designate the documents which were shown even if the index was updated since, without
+    running the query again for the preview and download. At most maxsize snapshots are kept, for
+    maxage seconds, each with at most maxresults positions."""
+    def __init__(self, maxsize, maxage, maxresults=10000):
+        self.maxsize = maxsize
+        self.maxage = maxage
+        self.maxresults = maxresults
+        self.lock = threading.Lock()
+        self.snaps = {}
+        self.hits = 0
+
+    def _get(self, snapid, fp):
+        entry = self.snaps.get(snapid)
+        if entry is None or entry['fp'] != fp:
+            return None
+        if time.monotonic() - entry['time'] > self.maxage:
+            del self.snaps[snapid]
+            return None
+        return entry
+
+    # Return the snapshot for the id and search fingerprint, as a copy, or None
+    def get(self, snapid, fp):
+        with self.lock:
+            entry = self._get(snapid, fp)
+            return dict(entry, udis=dict(entry['udis'])) if entry else None
+
+    def create(self, fp, gen, nres):
+        import secrets
+        snapid = secrets.token_urlsafe(9)
+        now = time.monotonic()
+        with self.lock:
+            self.snaps[snapid] = {'fp': fp, 'gen': gen, 'nres': nres, 'udis': {}, 'time': now}
+            # Oldest first
+            for k in list(self.snaps):
+                if len(self.snaps) <= self.maxsize and now - self.snaps[k]['time'] <= self.maxage:
+                    break
+                del self.snaps[k]
+        return snapid
+
+    def record(self, snapid, fp, offset, udis):
+        with self.lock:
+            entry = self._get(snapid, fp)
+            if entry is None:
+                return
+            for i, udi in enumerate(udis):
+                if len(entry['udis']) >= self.maxresults:
+                    break
+                entry['udis'][offset + i] = udi
+
+    # The rcludi of the result at position resnum, or None
+    def udi(self, snapid, fp, resnum):
+        with self.lock:
+            entry = self._get(snapid, fp)
+            udi = entry['udis'].get(resnum) if entry else None
+            if udi:
+                self.hits += 1
+            return udi
+
+    def size(self):
+        with self.lock:
+            return len(self.snaps)
+
+# None if disabled (webui_snapshots 0)
+def get_snapshots(state=None):
+    state = state or current_state()
+    with state.lock:
+        if state.snapshots is None:
+            val = state.param('snapshots')
+            maxsize = 500 if val is None else int(val)
+            val = state.param('snapshottime')
+            state.snapshots = ResultSnapshots(maxsize, 1800 if val is None else float(val))
+        return state.snapshots if state.snapshots.maxsize > 0 else None
+
+# The rcludi of a result designated by its position in the snapshot of the request (snap
+# parameter), or None
+def snapshot_udi(q, config, resnum):
+    snaps = get_snapshots()
+    if not snaps or not q.get('snap') or q.get('rcludi'):
+        return None
+    return snaps.udi(q['snap'], query_fingerprint(q, config), resnum)
+#}}}
+#{{{ health check
+# Check that the index can answer a trivial query within timeout seconds, using a pooled
+# connection. The query runs in a separate thread so that a hung index can't block the caller.
+# The check in progress, as (thread, result, deadline). Concurrent callers (watchdog, readiness
+# probes) share it.
+_g_health_check = None
+_g_health_lock = threading.Lock()
+
+def health_check(timeout=5.0):
+    global _g_health_check
+    def run(result):
+        try:
+            pool = get_dbpool()
+            db, lease = pool.acquire(*main_index())
+            query = db.query()
+            query.execute('recollwebuihealthcheck')
+            pool.release(db, lease)
+            result['ok'] = True
+        except Exception as ex:
+            result['error'] = '%s' % ex
+    with _g_health_lock:
+        check = _g_health_check
+        if check and check[0].is_alive():
+            # A check which timed out may still be blocked in the index: don't pile up others
+            # behind it
+            if time.monotonic() > check[2]:
+                msg("Health check: the previous check still has no answer from the index")
+                return False
+        else:
+            result = {}
+            thread = threading.Thread(target=run, args=(result,), daemon=True)
+            check = _g_health_check = (thread, result, time.monotonic() + timeout)
+            thread.start()
+    thread, result, _ = check
+    thread.join(timeout)
+    if thread.is_alive():
+        msg("Health check: no answer from the index after %.1f s" % timeout)
+        return False
+    if 'error' in result:
+        msg("Health check failed: %s" % result['error'])
+    return result.get('ok', False)
+
+# Readiness, for load balancers: the health_check() result is kept for webui_readycachetime
+# seconds (5), so that frequent probes don't each query the index. Checks run one at a time.
+def check_ready(state=None):
+    state = state or current_state()
+    val = state.param('readycachetime')
+    maxage = 5 if val is None else float(val)
+    val = state.param('readytimeout')
+    timeout = 2 if val is None else float(val)
+    with state.readylock:
+        if state.ready and time.monotonic() - state.ready[0] < maxage:
+            return state.ready[1]
+        ok = health_check(timeout)
+        state.ready = (time.monotonic(), ok)
+        return ok
+#}}}
+#{{{ admission control
+class AdmissionLane:
+    """Bound the number of requests of one kind executing at the same time. Requests over the
+    limit wait, up to maxqueue of them and for timeout seconds at most, else they are rejected."""
+    def __init__(self, name, concurrency, maxqueue, timeout):
+        self.name = name
+        self.concurrency = concurrency
+        self.maxqueue = maxqueue
+        self.timeout = timeout
+        self.cond = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def enter(self):
+        with self.cond:
+            if self.active < self.concurrency:
+                self.active += 1
+                return True
+            if self.waiting >= self.maxqueue:
+                self.rejected += 1
+                return False
+            self.waiting += 1
+            try:
+                deadline = time.monotonic() + self.timeout
+                while self.active >= self.concurrency:
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        self.timeouts += 1
+                        return False
+                    self.cond.wait(left)
+                self.active += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def leave(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify()
+
+# Lane name -> recoll.conf parameters for the concurrency and queue depth. Requests for static
+# files, the search form, settings and osd.xml don't go through a lane.
+_g_lanes_params = {
+    'search': ('maxsearches', 'searchqueue'),
+    'documents': ('maxdocrequests', 'docqueue'),
+}
+def get_lane(name):
+    state = current_state()
+    with state.lock:
+        if state.lanes is None:
+            lanes = {}
+            val = state.param('queuetimeout')
+            timeout = 10 if val is None else float(val)
+            for lname, (cparam, qparam) in _g_lanes_params.items():
+                val = state.param(cparam)
+                concurrency = 0 if val is None else int(val)
+                if concurrency <= 0:
+                    continue
+                val = state.param(qparam)
+                maxqueue = 2 * concurrency if val is None else int(val)
+                lanes[lname] = AdmissionLane(lname, concurrency, maxqueue, timeout)
+            state.lanes = lanes
+        return state.lanes.get(name)
+
+# Route decorator: run the handler inside the named admission lane, or answer 503 if the lane is
+# full. With coalesce, a request for a search identical to one in progress (see recoll_search())
+# does not take a place in the lane: it only waits for the other one's results. A streamed response
+# keeps its place until it is sent, unless streamwork is False (nothing costly left to do while
+# sending, e.g. a file already extracted).
+def admit(lanename, coalesce=False, streamwork=True):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            lane = get_lane(lanename)
+            if lane is None:
+                return func(*args, **kwargs)
+            if coalesce and _g_searchflight.calls:
+                config = get_config()
+                if _g_searchflight.running(search_key(get_query(config), config)):
+                    return func(*args, **kwargs)
+            with stage('queue'):
+                admitted = lane.enter()
+            if not admitted:
+                retry = str(max(1, int(lane.timeout)))
+                raise bottle.HTTPError(503, 'The server is busy, please retry later',
+                                       **{'Retry-After': retry})
+            try:
+                out = func(*args, **kwargs)
+            except:
+                lane.leave()
+                raise
+            if streamwork and isinstance(out, (types.GeneratorType, _OnClose)):
+                # Streamed response: the work happens while sending
+                return _OnClose(out, lane.leave)
+            lane.leave()
+            return out
+        return wrapper
+    return decorator
+#}}}
 #{{{ recoll_initsearch
-def recoll_initsearch(q):
+# Lease a Db for a search: the main index, and the others which have folders in the search. Returns
+# the Db, and the extra indexes.
+def search_db(q):
     config = get_config()
     confdir = config['confdir']
     dbs = []
@@ -326,26 +1834,26 @@ def recoll_initsearch(q):
     if config['extradbs']:
         dbs.extend(config['extradbs'])
 
-    db = recoll.connect(confdir, extra_dbs=dbs)
-
     # Compare to "None" because of the conv. to str done while setting from cookies
+    synonyms = None
     if config["synonyms"] and config["synonyms"] != "None":
-        try:
-            db.setSynonymsFile(config["synonyms"])
-        except:
-            # Only supported from recoll 1.40.3, just ignore the error for now
-            msg(f"Setting synonyms to [{config['synonyms']}] failed")
-            pass
+        synonyms = config["synonyms"]
+    return request_db(confdir, dbs, synonyms), dbs
 
+def recoll_initsearch(q):
+    config = get_config()
+    db, _ = search_db(q)
     db.setAbstractParams(config['maxchars'], config['context'])
     query = db.query()
     query.sortby(q['sort'], q['ascending'])
     try:
         qs = query_to_recoll_string(q)
-        if "logquery" in config and config["logquery"]:
-            msg(f"Query: {qs}")
-        query.execute(qs, config['stem'], config['stemlang'],
-                      collapseduplicates=config['collapsedups'])
+        with stage('execute'):
+            query.execute(qs, config['stem'], config['stemlang'],
+                          collapseduplicates=config['collapsedups'])
+        # For the slow query log. This must be done while we hold the Db.
+        if querylog_config(current_state())[1] > 0:
+            bottle.request.environ['webui.xquery'] = query.getxquery()
     except Exception as ex:
         msg("Query execute failed: %s" % ex)
         pass
@@ -359,83 +1867,693 @@ class HlMeths:
         return '</span>'
 #}}}
 #{{{ recoll_search
-def recoll_search(q):
-    config = get_config()
-    tstart = datetime.datetime.now()
-    results = []
-    query,_ = recoll_initsearch(q)
+# Per-request time limit for the searches, as a time.monotonic() value, or None
+def request_deadline(config):
+    if config['rclc_querytimeout'] <= 0:
+        return None
+    start = bottle.request.environ.get('webui.start', time.monotonic())
+    return start + config['rclc_querytimeout']
+
+# times: if not None, the time spent in the slow parts is added to it
+def doc_to_dict(doc, query, q, config, highlighter, times=None):
+    d = {}
+    for f in FIELDS:
+        v = getattr(doc, f)
+        if v is not None:
+            d[f] = v
+        else:
+            d[f] = ''
+    d['label'] = select([d['title'], os.path.basename(d['url']), '?'], [None, ''])
+    d['sha'] = hashlib.sha1((d['url']+d['ipath']).encode('utf-8')).hexdigest()
+    t0 = time.perf_counter()
+    d['time'] = timestr(d['mtime'], config['timefmt'])
+    t1 = time.perf_counter()
+    d['rcludi'] = doc['rcludi']
+    if 'snippets' in q and q['snippets']:
+        if highlighter:
+            d['snippet'] = query.makedocabstract(doc, methods=highlighter)
+        else:
+            d['snippet'] = query.makedocabstract(doc)
+        if times is not None:
+            times['abstract'] = times.get('abstract', 0.0) + time.perf_counter() - t1
+        if not d['snippet']:
+            try:
+                d['snippet'] = doc['abstract']
+            except:
+                pass
+    if times is not None:
+        times['timestr'] = times.get('timestr', 0.0) + t1 - t0
+    return d
+
+class SearchResults:
+    """Iterator over the result dicts for the requested page. Fetching stops when the request
+    deadline is reached, and truncated is then set. The time the consumer keeps the iterator
+    suspended (e.g. sending an export to a slow client) moves the deadline. The query itself
+    (query.execute()) can't be interrupted. done(self) is called when the iteration ends, cursors
+    has the cursors for the next and previous pages, and fetchone() replaces query.fetchone() if
+    set."""
+    def __init__(self, query, q, config, count, rcludi, deadline, done=None, cursors=None,
+                 fetchone=None):
+        self.query = query
+        self.fetchone = fetchone or query.fetchone
+        self.q = q
+        self.config = config
+        self.count = count
+        self.rcludi = rcludi
+        self.deadline = deadline
+        self.environ = bottle.request.environ
+        self.truncated = False
+        self.fetched = 0
+        # Set when the iteration ended by itself, not closed by the consumer
+        self.complete = False
+        self.done = done
+        self.cursors = cursors or {}
+        # The rcludi of the results
+        self.udis = []
+        # Stage times, added to the request's when done
+        self.times = {}
+        if 'highlight' in q and q['highlight']:
+            self.highlighter = HlMeths()
+        else:
+            self.highlighter = None
+
+    def __iter__(self):
+        try:
+            yield from self._iter()
+            self.complete = True
+        finally:
+            for name, secs in self.times.items():
+                add_stage_time(name, secs)
+            self.times = {}
+            if self.done:
+                self.done(self)
+                self.done = None
+
+    def _iter(self):
+        query = self.query
+        times = self.times
+        times.setdefault('fetch', 0.0)
+        udibreak = False
+        while self.fetched < self.count:
+            if self.deadline and time.monotonic() > self.deadline:
+                self.truncated = True
+                self.environ['webui.truncated'] = True
+                msg("Query deadline exceeded after %d results: %s" %
+                    (self.fetched, query_to_recoll_string(self.q)))
+                break
+            try:
+                t0 = time.perf_counter()
+                doc = self.fetchone()
+                times['fetch'] += time.perf_counter() - t0
+                # Later Recoll versions return None at EOL instead of
+                # exception This change restores conformance to PEP 249
+                # Python Database API Specification
+                if not doc:
+                    break
+                if self.rcludi:
+                    if doc['rcludi'] == self.rcludi:
+                        udibreak = True
+                    else:
+                        continue
+            except:
+                break
+            self.fetched += 1
+            d = doc_to_dict(doc, query, self.q, self.config, self.highlighter, times)
+            self.udis.append(d['rcludi'])
+            t0 = time.monotonic()
+            yield d
+            if self.deadline:
+                self.deadline += time.monotonic() - t0
+            if udibreak:
+                break
+
+# Run the search and position the query at the start of the requested page. Returns a
+# SearchResults iterator and the number of results. The query is taken from the open queries if
+# the same search was done recently, and kept there once the page is done, with its Db. The
+# results are recorded in the snapshot of the search (q['snap']), and a page which was already
+# produced comes from the snapshot if the index changed since.
+def recoll_start_search(q, config):
+    environ = bottle.request.environ
+    rcludi = q.get('rcludi') or None
+    openq = None if rcludi else get_openqueries()
+    fp = None if rcludi else query_fingerprint(q, config)
+    entry = openq.take(fp) if openq else None
+    if entry:
+        query, pool, db, lease = entry
+        db.setAbstractParams(config['maxchars'], config['context'])
+        environ.setdefault('webui.dbleases', []).append((pool, db, lease))
+        environ['webui.openquery'] = True
+    else:
+        query, db = recoll_initsearch(q)
+    # Shared with stream_export()
+    leases = environ.get('webui.dbleases', [])
+    leased = next((l for l in leases if l[1] is db), None)
     nres = query.rowcount
-    if "rcludi" in q and q["rcludi"]:
-        rcludi = q["rcludi"]
+    if rcludi:
         nres = 1
         q['page'] = 1
-    else:
-        rcludi = None
     if config['maxresults'] == 0:
         config['maxresults'] = nres
     if nres > config['maxresults']:
         nres = config['maxresults']
-    if config['perpage'] == 0 or q['page'] == 0:
+    onepage = config['perpage'] == 0 or q['page'] == 0
+    if onepage:
         config['perpage'] = nres
         q['page'] = 1
     offset = (q['page'] - 1) * config['perpage']
+    pos = None
+    if fp and leased and q.get('cursor') and not onepage:
+        pos = parse_cursor(q['cursor'], fp, leased[2][1])
+    # Result numbers (preview and download links) assume the page size did not change
+    if pos is not None and pos < nres and pos % config['perpage'] == 0:
+        offset = pos
+        q['page'] = pos // config['perpage'] + 1
 
-    if query.rowcount > 0:
-        if type(query.next) == int:
-            query.next = offset
+    # The lease key has the extra indexes: getDoc() can only find the documents of the main one
+    gen = leased[2][1] if leased else None
+    snaps = None
+    if fp and leased and not leased[2][0][1] and not onepage and nres > 0:
+        snaps = get_snapshots()
+    snap = snaps.get(q['snap'], fp) if snaps and q.get('snap') else None
+    fetchone = None
+    if snap and snap['gen'] != gen:
+        positions = range(offset, min(offset + config['perpage'], snap['nres']))
+        if all(p in snap['udis'] for p in positions):
+            nres = snap['nres']
+            udis = iter([snap['udis'][p] for p in positions])
+            def fetchone():
+                # Skip the documents which are not in the index any more
+                for udi in udis:
+                    doc = db.getDoc(udi)
+                    if doc:
+                        return doc
+                return None
         else:
-            query.scroll(offset, mode='absolute')
+            snap = None
+    if snaps and not snap:
+        q['snap'] = snaps.create(fp, gen, nres)
+    elif not snap:
+        q.pop('snap', None)
+
+    if not fetchone and query.rowcount > 0 and \
+       not (type(query.next) == int and query.next == offset):
+        with stage('scroll'):
+            if type(query.next) == int:
+                query.next = offset
+            else:
+                query.scroll(offset, mode='absolute')
 
-    if 'highlight' in q and q['highlight']:
-        highlighter = HlMeths()
+    cursors = {}
+    park = fp and openq and leased and not onepage and nres > config['perpage']
+    if park:
+        if offset + config['perpage'] < nres:
+            cursors['next'] = make_cursor(fp, offset + config['perpage'], gen)
+        if offset > 0:
+            cursors['prev'] = make_cursor(fp, max(0, offset - config['perpage']), gen)
+    def done(it):
+        if snaps and not fetchone:
+            snaps.record(q['snap'], fp, offset, it.udis)
+        # A consumer which stopped early (client gone) may have given the Db back already
+        if park and it.complete and leased in leases:
+            leases.remove(leased)
+            openq.put(fp, query, *leased)
+
+    _g_metrics.search_done(nres)
+    return SearchResults(query, q, config, config['perpage'], rcludi, request_deadline(config),
+                         done, cursors, fetchone), nres
+
+def _recoll_search(q, config):
+    it, nres = recoll_start_search(q, config)
+    results = list(it)
+    return results, nres, it.truncated, q['page'], q.get('snap'), it.cursors
+
+def recoll_search(q):
+    config = get_config()
+    tstart = datetime.datetime.now()
+    key = search_key(q, config)
+    ran = []
+    def run():
+        ran.append(True)
+        return _recoll_search(q, config)
+    # Coalesced requests only get this one, the stages are counted in the request which ran the
+    # search
+    with stage('search'):
+        if bottle.request.environ.get('webui.profile'):
+            results, nres, truncated, page, snap, cursors = run()
+        else:
+            results, nres, truncated, page, snap, cursors = _g_searchflight.do(key, run)
+    q['page'] = page
+    if snap:
+        q['snap'] = snap
     else:
-        highlighter = None
+        q.pop('snap', None)
+    note_search(q, config, nres, search_cache(ran), truncated)
+    tend = datetime.datetime.now()
+    return results, nres, tend - tstart, truncated, cursors
+
+# For the query log: whether the search ran, was continued from an open query, or was coalesced
+# with an identical one
+def search_cache(ran=True):
+    if not ran:
+        return 'coalesced'
+    return 'open' if bottle.request.environ.get('webui.openquery') else 'miss'
+#}}}
+#{{{ single-flight
+class SingleFlight:
+    """Coalesce identical concurrent calls: while a call for a key is running, other callers for
+    the same key wait for it and get the same result (or exception)."""
+    class _Call:
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
 
-    udibreak = False
-    while len(results) < config['perpage']:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.executions = 0
+        self.coalesced = 0
+
+    # Whether a call for the key is running. If it ends before a caller joins it, the caller will
+    # run the function itself.
+    def running(self, key):
+        with self.lock:
+            return key in self.calls
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = SingleFlight._Call()
+                self.executions += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.event.wait()
+            if call.error:
+                raise call.error
+            return call.result
         try:
-            doc = query.fetchone()
-            # Later Recoll versions return None at EOL instead of
-            # exception This change restores conformance to PEP 249
-            # Python Database API Specification
-            if not doc:
-                break
-            if rcludi:
-                if doc['rcludi'] == rcludi:
-                    udibreak = True
-                else:
+            call.result = fn()
+        except BaseException as ex:
+            call.error = ex
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+        return call.result
+
+_g_searchflight = SingleFlight()
+
+# Everything which determines the result of recoll_search(): the query parameters and the
+# configuration values coming from cookies or recoll.conf.
+def search_key(q, config):
+    return (config['confdir'], query_to_recoll_string(q), q['sort'], q['ascending'], q['page'],
+            q['highlight'], q['snippets'], q.get('rcludi'), q.get('cursor'), q.get('snap'),
+            config['stem'], config['stemlang'], config['collapsedups'], config['synonyms'],
+            config['perpage'], config['maxresults'], config['maxchars'], config['context'],
+            config['timefmt'], tuple(config['extraconfdirs'] or ()))
+#}}}
+#{{{ compile_templates
+# Compile all the templates once, for use when bottle is not in debug mode (in debug mode,
+# bottle.template() reloads them for each request). The templates share their include cache, so
+# that e.g. result.tpl is only compiled once, not once for every including template.
+def compile_templates():
+    import glob
+    compiled = {}
+    for path in bottle.TEMPLATE_PATH:
+        for fn in glob.glob(os.path.join(path, '*.tpl')):
+            name = os.path.splitext(os.path.basename(fn))[0]
+            if name in compiled:
+                continue
+            tpl = bottle.SimpleTemplate(name=name, lookup=bottle.TEMPLATE_PATH)
+            tpl.co
+            tpl.cache = compiled
+            compiled[name] = tpl
+            bottle.TEMPLATES[(id(bottle.TEMPLATE_PATH), name)] = tpl
+    return list(compiled.keys())
+#}}}
+#}}}
+#{{{ warmup
+# Run a request through the application, outside of any server, with the current server state or
+# the given one
+def internal_request(path, query_string='', state=None):
+    import wsgiref.util
+    environ = {}
+    wsgiref.util.setup_testing_defaults(environ)
+    environ['PATH_INFO'] = path
+    environ['QUERY_STRING'] = query_string
+    if state:
+        environ['webui.state'] = state
+    status = []
+    out = bottle.default_app()(environ, lambda s, h, e=None: status.append(s))
+    try:
+        for _ in out:
+            pass
+    finally:
+        if hasattr(out, 'close'):
+            out.close()
+    return status[0] if status else None
+
+# Return the n most frequent searches from a query log (see QueryLog, or the "Query: " lines
+# which webui_logquery used to print), as the query strings of their first result page
+def frequent_queries(logfile, n):
+    from urllib.parse import urlencode
+    json = json_module()
+    counts = {}
+    with open(logfile, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            if line.startswith('{'):
+                try:
+                    record = json.loads(line)
+                except ValueError:
                     continue
-        except:
-            break
-        d = {}
-        for f in FIELDS:
-            v = getattr(doc, f)
-            if v is not None:
-                d[f] = v
-            else:
-                d[f] = ''
-        d['label'] = select([d['title'], os.path.basename(d['url']), '?'], [None, ''])
-        d['sha'] = hashlib.sha1((d['url']+d['ipath']).encode('utf-8')).hexdigest()
-        d['time'] = timestr(d['mtime'], config['timefmt'])
-        d['rcludi'] = doc['rcludi']
-        if 'snippets' in q and q['snippets']:
-            if highlighter:
-                d['snippet'] = query.makedocabstract(doc, methods=highlighter)
+                qs = record.get('query')
+                qdir = record.get('dir') or '<all>'
+                # The logged query has the folder clause added by query_to_recoll_string()
+                clause = ' dir:"%s" ' % qdir
+                if qs and qdir != '<all>' and qs.endswith(clause):
+                    qs = qs[:-len(clause)]
+                else:
+                    qdir = '<all>'
+                key = (qs, qdir, record.get('sort') or '', record.get('ascending') or 0)
             else:
-                d['snippet'] = query.makedocabstract(doc)
-            if not d['snippet']:
-                try:
-                    d['snippet'] = doc['abstract']
-                except:
-                    pass
-        #for n,v in d.items():
-        #    print("type(%s) is %s" % (n,type(v)))
-        results.append(d)
-        if udibreak:
-            break
-    tend = datetime.datetime.now()
-    return results, nres, tend - tstart
+                pos = line.find('Query: ')
+                if pos < 0:
+                    continue
+                key = (line[pos+7:].strip(), '<all>', '', 0)
+            if key[0]:
+                counts[key] = counts.get(key, 0) + 1
+    out = []
+    for qs, qdir, sort, ascending in sorted(counts, key=lambda k: -counts[k])[:n]:
+        params = {'query': qs, 'page': 1}
+        if qdir != '<all>':
+            params['dir'] = qdir
+        if sort:
+            params['sort'] = sort
+            params['ascending'] = ascending
+        out.append(urlencode(params))
+    return out
+
+# Do the work which would otherwise fall on the first requests: compile the templates, open the
+# index, build the folder tree, and possibly run the most frequent queries from a query log
+# (default: webui_warmuplog and webui_warmupqueries from recoll.conf). With index False, only
+# compile the templates.
+def warmup(logfile=None, nqueries=None, state=None, index=True):
+    tstart = time.monotonic()
+    if not bottle.DEBUG and not bottle.TEMPLATES:
+        compile_templates()
+    if not index:
+        return
+    state = state or current_state()
+    # A failure here is the first request's problem, not a reason to refuse to start
+    try:
+        if logfile is None:
+            logfile = state.param('warmuplog') or state.param('querylog')
+        if nqueries is None:
+            val = state.param('warmupqueries')
+            nqueries = 20 if val is None else int(val)
+        warm_dbpool(state)
+    except Exception as ex:
+        msg("Warm-up: can't open the index: %s" % ex)
+        return
+    # The search form page builds the folder tree
+    status = internal_request('/', state=state)
+    if status != '200 OK':
+        msg("Warm-up: search form request failed: %s" % status)
+    queries = []
+    if logfile and nqueries > 0:
+        try:
+            queries = frequent_queries(logfile, nqueries)
+        except OSError as ex:
+            msg("Warm-up: can't read query log: %s" % ex)
+    for qs in queries:
+        status = internal_request('/results', qs, state)
+        if status != '200 OK':
+            msg("Warm-up: search %s failed: %s" % (qs, status))
+    msg("Warm-up done in %.2f s (%d queries)" % (time.monotonic() - tstart, len(queries)))
 #}}}
+#{{{ profiling
+# An admin can run a request under cProfile by adding profile=1&profiletoken=<webui_profiletoken>
+# to its URL. The response is then the profile report instead of the page. This covers the whole
+# request, including the search, the template rendering, the extraction and the sending of
+# streamed responses. One request is profiled at a time, and at most one every
+# webui_profileinterval seconds.
+_g_profile_lock = threading.Lock()
+_g_profile_last = 0
+
+def profiled(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if bottle.request.query.profile != '1':
+            return func(*args, **kwargs)
+        if not token_ok(bottle.request.query.profiletoken, 'profiletoken'):
+            bottle.abort(403, 'Profiling is not enabled, or bad profiletoken')
+        return _profile_request(func, args, kwargs)
+    return wrapper
+
+# Check a token from a request against a secret recoll.conf parameter (webui_<name>), which must
+# be set
+def token_ok(given, name):
+    import hmac
+    token = get_server_param(name)
+    return bool(token) and hmac.compare_digest(given.encode(), token.encode())
+
+def _profile_request(func, args, kwargs):
+    global _g_profile_last
+    val = get_server_param('profileinterval')
+    interval = 10 if val is None else float(val)
+    if not _g_profile_lock.acquire(blocking=False):
+        raise bottle.HTTPError(429, 'A request is already being profiled',
+                               **{'Retry-After': str(max(1, int(interval)))})
+    try:
+        wait = _g_profile_last + interval - time.monotonic()
+        if wait > 0:
+            raise bottle.HTTPError(429, 'Profiling is rate limited',
+                                   **{'Retry-After': str(max(1, int(wait + 1)))})
+        _g_profile_last = time.monotonic()
+        import cProfile
+        # Run our own search, not one coalesced with another request's
+        bottle.request.environ['webui.profile'] = True
+        prof = cProfile.Profile()
+        t0 = time.perf_counter()
+        prof.enable()
+        try:
+            size = _drain(func(*args, **kwargs))
+        finally:
+            prof.disable()
+        elapsed = time.perf_counter() - t0
+    finally:
+        _g_profile_lock.release()
+
+    import io
+    import pstats
+    params = '&'.join('%s=%s' % (k, v) for k, v in bottle.request.query.allitems()
+                      if k not in ('profile', 'profiletoken'))
+    out = io.StringIO()
+    out.write("%s?%s\n" % (bottle.request.path, params))
+    out.write("%.1f ms, %d bytes, status %s\n" % (elapsed * 1000, size, bottle.response.status))
+    out.write("Stages (ms): %s\n" % ', '.join('%s %.1f' % kv for kv in stage_times().items()))
+    profdir = get_server_param('profiledir')
+    if profdir:
+        fn = os.path.join(os.path.expanduser(profdir), '%s%s.prof' % (
+            time.strftime('%Y%m%d-%H%M%S'), normalise_filename(bottle.request.path)))
+        try:
+            prof.dump_stats(fn)
+            out.write("Saved to %s\n" % fn)
+        except OSError as ex:
+            out.write("Could not save to %s: %s\n" % (fn, ex))
+    stats = pstats.Stats(prof, stream=out)
+    stats.strip_dirs()
+    out.write("\n")
+    stats.sort_stats('cumulative').print_stats(40)
+    stats.sort_stats('tottime').print_stats(20)
+    bottle.response.status = 200
+    for h in ('Content-Disposition', 'Content-Length', 'Content-Range', 'ETag', 'Last-Modified'):
+        bottle.response.headers.pop(h, None)
+    bottle.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    bottle.response.headers['Cache-Control'] = 'no-store'
+    return out.getvalue()
+
+# Consume a route result, returning its size
+def _drain(out):
+    if isinstance(out, bottle.HTTPResponse):
+        out = out.body
+    if isinstance(out, (str, bytes)):
+        return len(out)
+    size = 0
+    try:
+        if hasattr(out, 'read'):
+            while True:
+                chunk = out.read(1024*1024)
+                if not chunk:
+                    break
+                size += len(chunk)
+        else:
+            for chunk in out:
+                size += len(chunk)
+    finally:
+        if hasattr(out, 'close'):
+            out.close()
+    return size
+#}}}
+#{{{ memory
+# Memory report for the admins (/memory?token=<webui_admintoken>): process size, size of the
+# caches, and tracemalloc snapshots, to find what grows in a long running server process. With
+# --workers, this is about the process which answered.
+_g_memory_lock = threading.Lock()
+_g_memory_snapshot = None
+
+# Resident and peak resident size of a process, in bytes, (None, None) if unknown
+def process_rss(pid='self'):
+    rss = peak = None
+    try:
+        with open('/proc/%s/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) * 1024
+                elif line.startswith('VmHWM:'):
+                    peak = int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        if pid == 'self':
+            try:
+                import resource
+                peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            except Exception:
+                pass
+    return rss, peak
+
+# Approximate size of an object and of what it contains, in bytes
+def deep_size(obj):
+    seen = {}
+    size = 0
+    todo = [obj]
+    while todo:
+        o = todo.pop()
+        if id(o) in seen:
+            continue
+        seen[id(o)] = True
+        size += sys.getsizeof(o)
+        if isinstance(o, dict):
+            todo.extend(o.keys())
+            todo.extend(o.values())
+        elif isinstance(o, (list, tuple)):
+            todo.extend(o)
+    return size
+
+def _mb(n):
+    return '?' if n is None else '%.1f MB' % (n / 1e6)
+
+# Sizes of the caches and pools of a state, as (name, bytes, details) tuples
+def cache_sizes(state):
+    sizes = []
+    with state.lock:
+        sizes.append(('folder tree cache', deep_size(state.dirscache),
+                      '%d trees' % len(state.dirscache)))
+        pool, cache, epool = state.dbpool, state.extractcache, state.extractpool
+        openq, snaps = state.openqueries, state.snapshots
+    if pool:
+        # The Xapian memory is not visible from Python, only in the process size
+        sizes.append(('index connections', None, '%d idle' % pool.size()))
+    if openq:
+        sizes.append(('open queries', None, '%d' % openq.size()))
+    if snaps:
+        with snaps.lock:
+            sizes.append(('result snapshots', deep_size(snaps.snaps), '%d' % len(snaps.snaps)))
+    if cache:
+        sizes.append(('extracted documents (disk)', cache.total, cache.dir))
+    if epool:
+        with epool.cond:
+            pids = [w.proc.pid for w in epool.idle]
+        rss = [process_rss(pid)[0] or 0 for pid in pids]
+        sizes.append(('idle extraction workers', sum(rss), '%d processes' % len(pids)))
+    sizes.append(('compiled templates', deep_size(bottle.TEMPLATES),
+                  '%d templates' % len(bottle.TEMPLATES)))
+    q = _g_querylog.queue
+    sizes.append(('query log queue', None, '%d records' % (q.qsize() if q else 0)))
+    sizes.append(('searches in progress', None, '%d' % len(_g_searchflight.calls)))
+    return sizes
+
+# The memory allocated from each line of webui.py, as {lineno: (bytes, blocks)}. An allocation
+# is attributed to the innermost webui.py frame of its traceback, so that the memory allocated in
+# bottle or recoll on behalf of a webui.py line is counted for it.
+def _memory_by_line(snapshot):
+    here = os.path.abspath(__file__)
+    lines = {}
+    for st in snapshot.statistics('traceback'):
+        lineno = 0
+        for frame in reversed(st.traceback):
+            if frame.filename == here:
+                lineno = frame.lineno
+                break
+        size, count = lines.get(lineno, (0, 0))
+        lines[lineno] = (size + st.size, count + st.count)
+    return lines
+
+# Leave out what the reports themselves allocate
+def _snapshot():
+    import tracemalloc
+    import linecache
+    snapshot = tracemalloc.take_snapshot()
+    return snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                   tracemalloc.Filter(False, linecache.__file__)])
+
+def _line_report(out, lines, top, diff):
+    import linecache
+    items = sorted(lines.items(), key=lambda kv: -abs(kv[1][0]))[:top]
+    for lineno, (size, count) in items:
+        where = 'webui.py:%d' % lineno if lineno else '(not from webui.py)'
+        src = linecache.getline(__file__, lineno).strip() if lineno else ''
+        out.append('  %-22s %14s %10s  %s' % (where, ('%+d' if diff else '%d') % size,
+                                               ('%+d' if diff else '%d') % count, src[:60]))
+
+# action: '' (report only), 'start', 'snapshot', 'diff' or 'stop' tracemalloc
+def memory_report(action='', top=25, frames=25):
+    global _g_memory_snapshot
+    import tracemalloc
+    out = []
+    with _g_memory_lock:
+        if action == 'start' and not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            _g_memory_snapshot = None
+        elif action == 'stop':
+            tracemalloc.stop()
+            _g_memory_snapshot = None
+        elif action in ('snapshot', 'diff') and not tracemalloc.is_tracing():
+            bottle.abort(409, 'tracemalloc is not tracing: use tracemalloc=start first')
+
+        rss, peak = process_rss()
+        out.append('Process %d: resident %s, peak %s' % (os.getpid(), _mb(rss), _mb(peak)))
+        out.append('Caches and pools (bytes):')
+        for name, size, details in cache_sizes(current_state()):
+            out.append('  %-28s %14s  %s' % (name, '-' if size is None else size, details))
+        if tracemalloc.is_tracing():
+            cur, tpeak = tracemalloc.get_traced_memory()
+            out.append('tracemalloc: tracing %d frames, traced %s, peak %s, overhead %s' %
+                       (tracemalloc.get_traceback_limit(), _mb(cur), _mb(tpeak),
+                        _mb(tracemalloc.get_tracemalloc_memory())))
+        else:
+            out.append('tracemalloc: not tracing')
+
+        if action == 'snapshot':
+            _g_memory_snapshot = _snapshot()
+            out.append('Allocated memory by webui.py line (bytes, blocks), new baseline:')
+            _line_report(out, _memory_by_line(_g_memory_snapshot), top, False)
+        elif action == 'diff':
+            if _g_memory_snapshot is None:
+                bottle.abort(409, 'No baseline: use tracemalloc=snapshot first')
+            before = _memory_by_line(_g_memory_snapshot)
+            after = _memory_by_line(_snapshot())
+            diffs = {}
+            for lineno in dict.fromkeys(list(before) + list(after)):
+                b, a = before.get(lineno, (0, 0)), after.get(lineno, (0, 0))
+                if a != b:
+                    diffs[lineno] = (a[0] - b[0], a[1] - b[1])
+            out.append('Change since the baseline by webui.py line (bytes, blocks):')
+            _line_report(out, diffs, top, True)
+    return '\n'.join(out) + '\n'
 #}}}
 #{{{ routes
 #{{{ static
@@ -445,41 +2563,81 @@ def server_static(path):
 #}}}
 #{{{ main
 @bottle.route('/')
-@bottle.view('main')
+@view('main')
 def main():
     config = get_config()
     bottle.response.headers['Vary'] = 'Cookie'
-    return { 'dirs': get_dirs(config['dirs'], config['dirdepth']),
+    return { 'dirs': get_dirs(config['dirs'], config['dirdepth'], config['rclc_dircachetime']),
             'query': get_query(config), 'sorts': SORTS, 'config': config}
 #}}}
 #{{{ results
 @bottle.route('/results')
-@bottle.view('results')
+@profiled
+@admit('search', coalesce=True)
+@view('results')
 def results():
     config = get_config()
     query = get_query(config)
     qs = query_to_recoll_string(query)
-    res, nres, timer = recoll_search(query)
+    res, nres, timer, truncated, cursors = recoll_search(query)
     if config['maxresults'] == 0:
         config['maxresults'] = nres
     if config['perpage'] == 0:
         config['perpage'] = nres
+    approx, count = result_count(nres, query['page'], len(res), config, truncated)
     bottle.response.headers['Vary'] = 'Cookie'
     bottle.response.headers['No-Vary-Search'] = 'key-order'
     return { 'res': res, 'time': timer, 'query': query, 'dirs':
-             get_dirs(config['dirs'], config['dirdepth']),
+             get_dirs(config['dirs'], config['dirdepth'], config['rclc_dircachetime']),
              'qs': qs, 'sorts': SORTS, 'config': config,
-             'query_string': bottle.request.query_string, 'nres': nres,
-             'config': config}
+             'query_string': links_query_string(query), 'nres': nres,
+             'approx': approx, 'count': count,
+             'truncated': truncated, 'config': config, 'cursors': cursors,
+             'timings': format_stage_times() if config['rclc_showtimings'] else ''}
+
+# Whether the result count is shown as an estimate (webui_approxcount), and the count to show,
+# rounded to two significant digits if it is one. The count is exact once the last page of
+# results was fetched.
+def result_count(nres, page, nshown, config, truncated=False):
+    threshold = config['rclc_approxcount']
+    if threshold <= 0 or nres < threshold:
+        return False, nres
+    last = (page - 1) * config['perpage'] + nshown
+    if not truncated and (nshown < config['perpage'] or last >= nres):
+        return False, last
+    return True, round(nres, 2 - len(str(nres)))
+
+# Query string for the links of a results page: the snapshot of the page instead of the cursor
+def links_query_string(query):
+    from urllib.parse import urlencode, parse_qsl
+    params = [(k, v) for k, v in parse_qsl(bottle.request.query_string, keep_blank_values=True)
+              if k not in ('cursor', 'snap')]
+    if query.get('snap'):
+        params.append(('snap', query['snap']))
+    return urlencode(params)
+
+# Stage times for the footer. The rendering is not done yet, it's only in the Server-Timing header.
+def format_stage_times():
+    return ', '.join('%s %.1f ms' % (k, v) for k, v in stage_times().items())
 #}}}
 #{{{ preview
 @bottle.route('/preview/<resnum:int>')
+@profiled
+@admit('documents')
 def preview(resnum):
     config = get_config()
     query = get_query(config)
     qs = query_to_recoll_string(query)
-    rclq,db = recoll_initsearch(query)
-    if "rcludi" in query and query["rcludi"]:
+    udi = snapshot_udi(query, config, resnum)
+    if udi:
+        # The result which was shown, without running the query
+        rclq = None
+        db, _ = search_db(query)
+        doc = db.getDoc(udi)
+        if not doc:
+            bottle.abort(404, 'The document is not in the index any more')
+    elif "rcludi" in query and query["rcludi"]:
+        rclq,db = recoll_initsearch(query)
         # Permlinks active
         # Notes: if the initial path had non-utf8 chars, they would have \xnn encoded and we should
         # decode them with codecs.escape_decode(query['rcludi']. Howvever, this is not foolproof
@@ -490,12 +2648,12 @@ def preview(resnum):
         # 1.43.13, and we will have to add the idxi to the urls along with rcludi
         doc = db.getDoc(query['rcludi'])
     else:
+        rclq,db = recoll_initsearch(query)
         if resnum > rclq.rowcount - 1:
             return 'Bad result index %d' % resnum
         rclq.scroll(resnum)
         doc = rclq.fetchone()
-    xt = rclextract.Extractor(doc)
-    tdoc = xt.textextract(doc.ipath)
+    tdoc = extract_text(doc, config)
     if tdoc.mimetype == 'text/html':
         ishtml = 1
         bottle.response.content_type = 'text/html; charset=utf-8'
@@ -503,6 +2661,8 @@ def preview(resnum):
         ishtml = 0
         bottle.response.content_type = 'text/plain; charset=utf-8'
     if 'highlight' in query and query['highlight']:
+        if rclq is None:
+            rclq,_ = recoll_initsearch(query)
         hl = HlMeths()
         txt = rclq.highlight(tdoc.text, ishtml=ishtml, methods=hl)
         pos = txt.find('<head>')
@@ -521,39 +2681,215 @@ def preview(resnum):
 #}}}
 #{{{ download
 @bottle.route('/download/<resnum:int>')
+@profiled
+@admit('documents', streamwork=False)
 def edit(resnum):
     config = get_config()
     query = get_query(config)
     qs = query_to_recoll_string(query)
-    rclq,db = recoll_initsearch(query)
-    if "rcludi" in query and query["rcludi"]:
+    udi = snapshot_udi(query, config, resnum)
+    if udi:
+        db, _ = search_db(query)
+        doc = db.getDoc(udi)
+        if not doc:
+            bottle.abort(404, 'The document is not in the index any more')
+    elif "rcludi" in query and query["rcludi"]:
+        rclq,db = recoll_initsearch(query)
         # See comment in preview
         doc = db.getDoc(query['rcludi'])
     else:
+        rclq,db = recoll_initsearch(query)
         if resnum > rclq.rowcount - 1:
             return 'Bad result index %d' % resnum
         rclq.scroll(resnum)
         doc = rclq.fetchone()
+    bottle.response.headers['Vary'] = 'Cookie'
+    bottle.response.headers['No-Vary-Search'] = 'key-order'
+    # Check for a conditional request before doing the possibly expensive extraction
+    etag = doc_etag(doc)
+    mtime = doc_mtime(doc)
+    if not_modified(etag, mtime):
+        bottle.response.headers['ETag'] = etag
+        if mtime:
+            bottle.response.headers['Last-Modified'] = bottle.http_date(mtime)
+        bottle.response.status = 304
+        return ''
     bottle.response.content_type = doc.mimetype
-    xt = rclextract.Extractor(doc)
-    path = xt.idoctofile(doc.ipath, doc.mimetype)
+    f = doc_to_file(doc, config)
     if "filename" in doc.keys():
         filename = doc.filename
     else:
-        filename = os.path.basename(path)
+        filename = os.path.basename(os.fsdecode(f.name))
     bottle.response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
-    bottle.response.headers['Content-Length'] = os.stat(path).st_size
-    f = open(path, 'rb')
-    try:
-        os.unlink(path)
-    except:
+    size = os.fstat(f.fileno()).st_size
+    return send_file_ranges(f, size, etag, mtime, doc.mimetype)
+#}}}
+#{{{ zip
+# Types for which compressing again is a waste of time
+_g_compressed_types = ('image/jpeg', 'image/png', 'image/gif', 'image/webp', 'video/',
+                       'audio/mpeg', 'audio/ogg', 'audio/mp4', 'audio/aac', 'audio/flac',
+                       'application/zip', 'application/gzip', 'application/x-gzip',
+                       'application/x-bzip2', 'application/x-xz', 'application/x-7z-compressed',
+                       'application/x-rar', 'application/vnd.rar', 'application/zstd',
+                       'application/epub+zip', 'application/vnd.openxmlformats-officedocument',
+                       'application/vnd.oasis.opendocument')
+
+def zip_compress_type(mimetype):
+    import zipfile
+    if mimetype and mimetype.startswith(_g_compressed_types):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+# Parse a selection like "1,4,7-10" into a sorted list of result indices
+def parse_selection(sel, maxcount):
+    # Note: set() is the settings route in this module, use a dict
+    out = {}
+    for part in sel.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        try:
+            first = int(first)
+            last = int(last) if last else first
+        except ValueError:
+            bottle.abort(400, 'Bad or too large selection')
+        if first < 0 or last < first or len(out) + last - first >= maxcount:
+            bottle.abort(400, 'Bad or too large selection')
+        out.update(dict.fromkeys(range(first, last + 1)))
+    return sorted(out)
+
+class _ZipStream:
+    """Non-seekable file object for zipfile, which we empty after each write so that the archive
+    can be streamed without ever being stored whole."""
+    def __init__(self):
+        self.chunks = []
+        self.pos = 0
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.pos += len(data)
+        return len(data)
+    def tell(self):
+        return self.pos
+    def flush(self):
         pass
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def _zip_entry_name(doc, used):
+    name = select([doc.filename, os.path.basename(doc.url or ''), 'document'], [None, ''])
+    name = name.replace('/', '_').replace('\\', '_')
+    base, ext = os.path.splitext(name)
+    n = 1
+    while name in used:
+        n += 1
+        name = '%s-%d%s' % (base, n, ext)
+    used[name] = True
+    return name
+
+def zip_stream(docs, config, bufsize=1024*1024):
+    import zipfile
+    out = _ZipStream()
+    used = {}
+    with zipfile.ZipFile(out, mode='w', allowZip64=True) as zf:
+        for doc in docs:
+            try:
+                f = doc_to_file(doc, config)
+            except Exception as ex:
+                msg("zip: skipping %s: %s" % (doc.url, ex))
+                continue
+            try:
+                zinfo = zipfile.ZipInfo(_zip_entry_name(doc, used),
+                                        time.localtime(max(doc_mtime(doc), 315532800))[:6])
+                zinfo.compress_type = zip_compress_type(doc.mimetype)
+                zinfo.file_size = os.fstat(f.fileno()).st_size
+                with zf.open(zinfo, mode='w') as dst:
+                    while True:
+                        data = f.read(bufsize)
+                        if not data:
+                            break
+                        dst.write(data)
+                        yield out.take()
+            finally:
+                f.close()
+            yield out.take()
+    yield out.take()
+
+@bottle.route('/zip')
+@profiled
+@admit('documents')
+def get_zip():
+    config = get_config()
+    if config['rclc_nozip']:
+        bottle.abort(403, 'Archive download is disabled')
+    query = get_query(config)
+    query.pop('rcludi', None)
+    qs = query_to_recoll_string(query)
+    udis = bottle.request.query.getall('udi')
+    if len(udis) > config['rclc_zipmaxfiles']:
+        bottle.abort(400, 'Bad or too large selection')
+    indices = parse_selection(bottle.request.query.sel or '', config['rclc_zipmaxfiles'] -
+                              len(udis))
+    if not udis and not indices:
+        bottle.abort(400, 'No documents selected')
+    # The results which were shown, from the snapshot
+    shown = [snapshot_udi(query, config, resnum) for resnum in indices]
+    if all(shown):
+        udis = udis + shown
+        indices = []
+        db, _ = search_db(query)
+    else:
+        rclq,db = recoll_initsearch(query)
+    docs = []
+    for udi in udis:
+        # See comment in preview about rcludi
+        doc = db.getDoc(udi)
+        if doc:
+            docs.append(doc)
+    for resnum in indices:
+        if resnum > rclq.rowcount - 1:
+            break
+        rclq.scroll(resnum, mode='absolute')
+        doc = rclq.fetchone()
+        if doc:
+            docs.append(doc)
     bottle.response.headers['Vary'] = 'Cookie'
     bottle.response.headers['No-Vary-Search'] = 'key-order'
-    return f
+    bottle.response.headers['Content-Type'] = 'application/zip'
+    bottle.response.headers['Content-Disposition'] = \
+      'attachment; filename=recoll-%s.zip' % normalise_filename(qs)
+    return streamed_body(zip_stream(docs, config))
+#}}}
+#{{{ stream_export
+# Stream a JSON or CSV export. Results are fetched while sending, so the fetch loop stops if the
+# client goes away (the server then closes the iterator). The Db leased for the request is still
+# in use while streaming: take it from the request, it goes back to the pool at the end.
+def stream_export(chunks, it, qs):
+    environ = bottle.request.environ
+    leases = environ.pop('webui.dbleases', None)
+    return streamed_body(_stream_export(chunks, it, qs, leases, environ))
+
+def _stream_export(chunks, it, qs, leases, environ):
+    try:
+        for chunk in chunks:
+            yield chunk
+    except GeneratorExit:
+        environ['webui.disconnected'] = True
+        msg("Client disconnected after %d results: %s" % (it.fetched, qs))
+        raise
+    finally:
+        # Finish the iteration (SearchResults.done) before the Dbs go back to the pool
+        chunks.close()
+        if leases:
+            for pool, db, lease in leases:
+                pool.release(db, lease)
 #}}}
 #{{{ json
 @bottle.route('/json')
+@profiled
+@admit('search')
 def get_json():
     config = get_config()
     query = get_query(config)
@@ -563,18 +2899,34 @@ def get_json():
     bottle.response.headers['Content-Type'] = 'application/json'
     bottle.response.headers['Content-Disposition'] = \
       'attachment; filename=recoll-%s.json' % normalise_filename(qs)
-    res, nres, timer = recoll_search(query)
-    ures = []
-    for d in res:
-        ud={}
-        for f,v in d.items():
-            ud[f] = v
-        ures.append(ud)
-    res = ures
-    return json.dumps({ 'query': query, 'results': res })
+    it, nres = recoll_start_search(query, config)
+    note_search(query, config, nres, search_cache())
+    return stream_export(json_chunks(query, it, nres), it, qs)
+
+def json_chunks(query, it, nres):
+    json = json_module()
+    yield '{"query": %s, "results": [' % json.dumps(query)
+    sep = ''
+    for d in it:
+        yield sep + json.dumps(d)
+        sep = ', '
+    yield ']'
+    # Parameters for the next and previous pages
+    for name in ('next', 'prev'):
+        if name in it.cursors:
+            page = query['page'] + (1 if name == 'next' else -1)
+            params = {'page': page, 'cursor': it.cursors[name]}
+            if query.get('snap'):
+                params['snap'] = query['snap']
+            yield ', "%s": %s' % (name, json.dumps(params))
+    approx, count = result_count(nres, query['page'], it.fetched, it.config, it.truncated)
+    yield ', "nres": %d, "approximate": %s' % (count, 'true' if approx else 'false')
+    yield ', "truncated": %s}' % ('true' if it.truncated else 'false')
 #}}}
 #{{{ csv
 @bottle.route('/csv')
+@profiled
+@admit('search')
 def get_csv():
     config = get_config()
     query = get_query(config)
@@ -586,12 +2938,20 @@ def get_csv():
     bottle.response.headers['Content-Type'] = 'text/csv'
     bottle.response.headers['Content-Disposition'] = \
       'attachment; filename=recoll-%s.csv' % normalise_filename(qs)
-    res, nres, timer = recoll_search(query)
+    it, nres = recoll_start_search(query, config)
+    note_search(query, config, nres, search_cache())
+    return stream_export(csv_chunks(config['csvfields'].split(), it), it, qs)
+
+# The output has no final line terminator, so each chunk is sent without its last one, which is
+# prepended to the next chunk.
+def csv_chunks(fields, it):
+    import csv
+    import io
     si = io.StringIO()
     cw = csv.writer(si)
-    fields = config['csvfields'].split()
     cw.writerow(fields)
-    for doc in res:
+    sep = ''
+    for n, doc in enumerate(it):
         row = []
         for f in fields:
             if f in doc:
@@ -599,11 +2959,65 @@ def get_csv():
             else:
                 row.append('')
         cw.writerow(row)
-    return si.getvalue().strip("\r\n")
+        if n % 100 == 99:
+            yield sep + si.getvalue()[:-2]
+            sep = '\r\n'
+            si.seek(0)
+            si.truncate()
+    # CSV has no place for it, a last row flags incomplete exports
+    if it.truncated:
+        cw.writerow(['# time limit reached, the results are incomplete'])
+    data = si.getvalue().rstrip("\r\n")
+    if data:
+        yield sep + data
+#}}}
+#{{{ metrics
+@bottle.route('/metrics')
+def get_metrics():
+    val = get_server_param('nometrics')
+    if val and int(val):
+        bottle.abort(404)
+    bottle.response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    bottle.response.headers['Cache-Control'] = 'no-store'
+    return metrics_text()
+#}}}
+#{{{ memory
+@bottle.route('/memory')
+def get_memory():
+    if not get_server_param('admintoken'):
+        bottle.abort(404)
+    if not token_ok(bottle.request.query.token, 'admintoken'):
+        bottle.abort(403, 'Bad token')
+    top = int(select([bottle.request.query.top, 25], [None, '']))
+    frames = int(select([bottle.request.query.frames, 25], [None, '']))
+    action = bottle.request.query.tracemalloc
+    if action not in ('', 'start', 'snapshot', 'diff', 'stop'):
+        bottle.abort(400, 'tracemalloc must be start, snapshot, diff or stop')
+    bottle.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    bottle.response.headers['Cache-Control'] = 'no-store'
+    return memory_report(action, top, frames)
+#}}}
+#{{{ healthz/readyz
+# Liveness: the process answers. No configuration, index or file system access.
+@bottle.route('/healthz')
+def healthz():
+    bottle.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    bottle.response.headers['Cache-Control'] = 'no-store'
+    return 'ok\n'
+
+# Readiness: the index answers
+@bottle.route('/readyz')
+def readyz():
+    bottle.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    bottle.response.headers['Cache-Control'] = 'no-store'
+    if not check_ready():
+        bottle.response.status = 503
+        return 'not ready\n'
+    return 'ready\n'
 #}}}
 #{{{ settings/set
 @bottle.route('/settings')
-@bottle.view('settings')
+@view('settings')
 def settings():
     return get_config()
 
@@ -625,7 +3039,7 @@ def set():
 #}}}
 #{{{ osd
 @bottle.route('/osd.xml')
-@bottle.view('osd')
+@view('osd')
 def main():
     #config = get_config()
     url = bottle.request.urlparts